@@ -0,0 +1,9 @@
+# The modules are imported as the "common" package of HoneyWalt (common.utils.*)
+import os, sys, types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if "common" not in sys.modules:
+	common = types.ModuleType("common")
+	common.__path__ = [ROOT]
+	sys.modules["common"] = common
@@ -0,0 +1,47 @@
+import multiprocessing
+
+from common.utils.capture import CAPTURE_IN, CaptureRing, read_capture
+
+# Payload of the record seq (its length varies, so that records straddle each other)
+def payload(seq):
+	return bytes([seq % 256]) * (50+seq*7 % 300)
+
+def test_read_capture(tmp_path):
+	path = str(tmp_path/"ring")
+	ring = CaptureRing(path, size=4096)
+	for seq in range(100):
+		ring.write(CAPTURE_IN, "10.0.0.1", 1000+seq, payload(seq))
+	records = list(read_capture(path))
+	assert records and records[-1][0] == 99
+	assert [ record[0] for record in records ] == list(range(100-len(records), 100))
+	for seq, _, direction, host, port, origlen, data in records:
+		assert (direction, host, port, data) == (CAPTURE_IN, "10.0.0.1", 1000+seq, payload(seq))
+	assert [ record[0] for record in read_capture(path, after=97) ] == [98, 99]
+	ring.close()
+
+def write_forever(path):
+	ring = CaptureRing(path, size=8192)
+	seq = 0
+	while True:
+		ring.write(CAPTURE_IN, "10.0.0.1", seq % 65536, payload(seq))
+		seq += 1
+
+# Records read while the ring is overwritten (by another process) are never torn
+def test_read_while_writing(tmp_path):
+	path = str(tmp_path/"ring")
+	CaptureRing(path, size=8192).close()
+	writer = multiprocessing.get_context("fork").Process(target=write_forever, args=(path,), daemon=True)
+	writer.start()
+	try:
+		nb = 0
+		for _ in range(2000):
+			last = None
+			for seq, _, _, host, port, _, data in read_capture(path):
+				assert last is None or seq > last
+				assert (host, port, data) == ("10.0.0.1", seq % 65536, payload(seq))
+				last = seq
+				nb += 1
+		assert nb > 0
+	finally:
+		writer.kill()
+		writer.join()
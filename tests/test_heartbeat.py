@@ -0,0 +1,48 @@
+import pickle, socket, threading, time
+
+from common.utils.heartbeat import Heartbeat
+from common.utils.sockets import ServerSocket
+
+# VM side (TCLIENT+HSERVER): answers the commands until answering is cleared
+def peer(sock, answering):
+	while True:
+		try:
+			cmd = sock.recv(1)
+		except OSError:
+			break
+		if not cmd: break
+		if answering.is_set():
+			serial = pickle.dumps({"success": True, "answer": None})
+			sock.sendall(len(serial).to_bytes(4, "big")+serial)
+
+def wait_until(condition, timeout=5):
+	end = time.monotonic()+timeout
+	while not condition() and time.monotonic() < end:
+		time.sleep(0.01)
+	return condition()
+
+# Controller side (TSERVER+HCLIENT)
+def test_heartbeat_server_socket():
+	server = ServerSocket(0, addr="127.0.0.1", reusable=True)
+	assert server.bind()
+	client = socket.create_connection(server.listen_socket.getsockname())
+	assert server.accept()
+	answering = threading.Event()
+	answering.set()
+	thread = threading.Thread(target=peer, args=(client, answering), daemon=True)
+	thread.start()
+	dead = []
+	heartbeat = Heartbeat(server, interval=0.2, timeout=0.5, on_dead=dead.append, keepalive=False)
+	heartbeat.start()
+	try:
+		assert wait_until(lambda: heartbeat.pings >= 2)
+		assert heartbeat.deaths == 0 and heartbeat.last_rtt is not None
+		answering.clear()
+		assert wait_until(lambda: heartbeat.deaths == 1)
+		assert dead == [server]
+		assert heartbeat.thread.is_alive()
+	finally:
+		heartbeat.stop()
+		client.close()
+		thread.join(timeout=5)
+		server.close()
@@ -0,0 +1,51 @@
+import threading
+
+from common.utils.controller import Controller
+from common.utils.instrument import Instrumentation, instrumentation
+from common.utils.sockets import ClientSocket, ServerSocket
+from common.vm.proto import CMD_VM_WG_UP, CMD_VM_WG_DOWN
+
+def failing_hook(name, metric, value):
+	raise ValueError("sink unavailable")
+
+def test_failing_hook():
+	metrics = Instrumentation()
+	metrics.add_hook(failing_hook)
+	metrics.record(CMD_VM_WG_UP, calls=1, handler_time=0.01)
+	assert metrics.get_stats()["CMD_VM_WG_UP"]["calls"] == 1
+
+def pair():
+	server = ServerSocket(0, addr="127.0.0.1", reusable=True)
+	assert server.bind()
+	client = ClientSocket()
+	thread = threading.Thread(target=client.connect, args=("127.0.0.1", server.listen_socket.getsockname()[1]))
+	thread.start()
+	assert server.accept()
+	thread.join()
+	return server, client
+
+class EchoController(Controller):
+	def loop(self):
+		while True:
+			cmd = self.socket.recv_cmd()
+			if cmd is None: return
+			self.exec_cmd(cmd, lambda cmd: {"success": True, "answer": cmd}, cmd)
+
+# The answers are sent and the conflict groups advance when a hook fails
+def test_failing_hook_in_controller():
+	server, client = pair()
+	controller = EchoController()
+	controller.socket = server
+	controller.start_workers(2)
+	controller.declare_conflict(CMD_VM_WG_UP, CMD_VM_WG_DOWN)
+	thread = threading.Thread(target=controller.loop)
+	thread.start()
+	instrumentation.add_hook(failing_hook)
+	try:
+		for cmd in [CMD_VM_WG_UP, CMD_VM_WG_DOWN, CMD_VM_WG_UP]:
+			assert client.exchange([cmd], timeout=5) == cmd
+	finally:
+		instrumentation.remove_hook(failing_hook)
+		client.close()
+		thread.join(timeout=5)
+		controller.stop_workers()
@@ -0,0 +1,144 @@
+import os, socket, threading, time
+
+from common.utils.shaper import BLOCK, MemoryBudget, Shaper, ShaperEngine, TokenBucket
+
+# Shaper sending to the address of a test socket
+class Sender(Shaper):
+	def __init__(self, target, **kwargs):
+		Shaper.__init__(self, **kwargs)
+		self.target = target
+
+	def prepare(self):
+		self.sock.bind(("127.0.0.1", 0))
+		self.udp_host, self.udp_port = self.target
+
+class Peer(Shaper):
+	def prepare(self):
+		self.sock.bind(("127.0.0.1", 0))
+
+def receiver():
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sock.bind(("127.0.0.1", 0))
+	sock.settimeout(2)
+	return sock
+
+def wait_until(condition, timeout=2):
+	end = time.monotonic()+timeout
+	while not condition() and time.monotonic() < end:
+		time.sleep(0.01)
+	return condition()
+
+def make_shaper(target, budget=10000, **kwargs):
+	engine = ShaperEngine(name="test-engine")
+	shaper = Sender(target, engine=engine, budget=MemoryBudget(budget), **kwargs)
+	return pair_shaper(shaper, engine)
+
+def pair_shaper(shaper, engine):
+	peer = Peer(engine=shaper.engine)
+	shaper.set_peer(peer)
+	peer.set_peer(shaper)
+	return shaper, peer, engine
+
+# Without engine until started (the default engine)
+def test_forward_before_start():
+	sock = receiver()
+	shaper, peer, engine = pair_shaper(Sender(sock.getsockname(), budget=MemoryBudget(10000)), None)
+	try:
+		for _ in range(5):
+			shaper.forward(b"x"*100)
+		shaper.start(show_status=False)
+		for _ in range(5):
+			assert sock.recvfrom(1000)[0] == b"x"*100
+		assert wait_until(lambda: shaper.queued_bytes == 0)
+		assert shaper.budget.used == 0
+	finally:
+		shaper.stop()
+		sock.close()
+
+def test_stop_drops_queued_packets():
+	sock = receiver()
+	shaper, peer, engine = make_shaper(sock.getsockname(), latency=10)
+	try:
+		shaper.start(show_status=False)
+		for _ in range(5):
+			shaper.forward(b"x"*100)
+		assert wait_until(lambda: shaper.queued_bytes == 500)
+		shaper.stop()
+		assert shaper.queued_bytes == 0 and shaper.budget.used == 0
+		assert shaper.queue_length() == 0
+		shaper.latency = 0
+		shaper.start(show_status=False)
+		shaper.forward(b"y"*100)
+		assert sock.recvfrom(1000)[0] == b"y"*100
+		assert wait_until(lambda: shaper.budget.used == 0)
+		# Stopped while paced: the next start sends again
+		shaper.bucket = TokenBucket(1000, 100)
+		shaper.forward(b"p"*100)
+		shaper.forward(b"p"*100)
+		assert sock.recvfrom(1000)[0] == b"p"*100
+		assert wait_until(lambda: shaper.paced)
+		shaper.stop()
+		assert not shaper.paced
+		shaper.start(show_status=False)
+		shaper.forward(b"z"*100)
+		assert sock.recvfrom(1000)[0] == b"z"*100
+	finally:
+		shaper.stop()
+		engine.stop()
+		sock.close()
+
+# Packets that cannot be sent are dropped with their accounting
+def test_send_error_releases_budget():
+	shaper, peer, engine = make_shaper(("255.255.255.255", 9), policy=BLOCK, max_packets=2)
+	try:
+		peer.start(show_status=False)
+		shaper.start(show_status=False)
+		for _ in range(5):
+			shaper.forward(b"x"*100)
+		assert wait_until(lambda: shaper.total_dropped == 5)
+		assert shaper.queued_bytes == 0 and shaper.budget.used == 0
+		assert not shaper.blocking
+	finally:
+		shaper.stop()
+		peer.stop()
+		engine.stop()
+
+# With GSO, oversize and single packets take the plain path
+def test_gso_oversize_packet():
+	sock = receiver()
+	shaper, peer, engine = make_shaper(sock.getsockname(), budget=200000, offload=True)
+	try:
+		shaper.start(show_status=False)
+		if not shaper.gso: return # Not supported here
+		for data in [b"x"*70000, b"y"*100, b"y"*100, b"z"*50]:
+			shaper.forward(data)
+		assert [ sock.recvfrom(1000)[0] for _ in range(3) ] == [b"y"*100, b"y"*100, b"z"*50]
+		assert wait_until(lambda: shaper.queued_bytes == 0)
+		assert shaper.total_dropped == 1 and shaper.budget.used == 0
+	finally:
+		shaper.stop()
+		engine.stop()
+		sock.close()
+
+# A wakeup requested by another thread while the loop drains the wake channel is not lost
+def test_wake_during_drain(monkeypatch):
+	engine = ShaperEngine(name="test-engine", timeout=3)
+	read = os.read
+	def read_after_wake(fd, size):
+		monkeypatch.setattr(os, "read", read)
+		engine.wake() # From another thread, just before the channel is read
+		return read(fd, size)
+	engine.wake()
+	monkeypatch.setattr(os, "read", read_after_wake)
+	engine.drain_wake()
+	assert not engine.wake_pending
+	engine.start()
+	try:
+		time.sleep(0.1) # The loop waits in select
+		done = threading.Event()
+		start = time.monotonic()
+		engine.call_soon(done.set)
+		assert done.wait(5)
+		assert time.monotonic()-start < 1
+	finally:
+		engine.stop()
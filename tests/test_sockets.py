@@ -0,0 +1,194 @@
+import fcntl, os, pickle, pytest, socket, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+from common.utils.serializers import CODECS
+from common.utils.sockets import SHM_SEALS, ClientSocket, ServerSocket
+
+# Answer (command, data) after data seconds, if data is a number
+def handler(conn):
+	cmd = conn.recv_cmd()
+	if cmd is None: return
+	data = conn.recv_obj() if cmd == 2 else None
+	if isinstance(data, (int, float)): time.sleep(data)
+	conn.send_obj({"success": True, "answer": (cmd, data)})
+
+def start_server(allow_multiplex=True):
+	server = ServerSocket(0, addr="127.0.0.1", reusable=True, backlog=16)
+	server.allow_multiplex = allow_multiplex
+	assert server.bind()
+	server.port = server.listen_socket.getsockname()[1]
+	thread = threading.Thread(target=server.serve, args=(handler, 8, 0.5), daemon=True)
+	thread.start()
+	return server, thread
+
+def stop_server(server, thread):
+	server.stop()
+	thread.join(timeout=5)
+
+def run_concurrently(client, nb=8):
+	with ThreadPoolExecutor(nb) as executor:
+		return list(executor.map(lambda i: client.exchange([2], 0.05+i*0.01, timeout=5), range(nb)))
+
+def check_reconnects(multiplex, allow_multiplex=True):
+	server, thread = start_server(allow_multiplex)
+	client = ClientSocket(multiplex=multiplex)
+	client.connect_timeout = 5
+	try:
+		assert client.connect("127.0.0.1", server.port)
+		assert client.multiplexed == (multiplex and allow_multiplex)
+		assert run_concurrently(client) == [ (2, 0.05+i*0.01) for i in range(8) ]
+		for _ in range(3):
+			# Connection lost: the next exchanges reopen it
+			client.socket.shutdown(2)
+			time.sleep(0.1)
+			assert client.exchange([4], timeout=5) == (4, None)
+			assert client.exchange([5], timeout=5) == (5, None)
+			assert client.multiplexed == (multiplex and allow_multiplex)
+			assert run_concurrently(client) == [ (2, 0.05+i*0.01) for i in range(8) ]
+	finally:
+		client.close()
+		stop_server(server, thread)
+
+def test_multiplexed_reconnect():
+	check_reconnects(True)
+
+def test_lockstep_reconnect():
+	check_reconnects(False)
+
+def test_multiplex_refused_reconnect():
+	check_reconnects(True, allow_multiplex=False)
+
+def test_connection_lost_in_flight():
+	server, thread = start_server()
+	client = ClientSocket(multiplex=True)
+	try:
+		assert client.connect("127.0.0.1", server.port)
+		with ThreadPoolExecutor(4) as executor:
+			futures = [ executor.submit(client.exchange, [2], 1, 5, 0) for _ in range(4) ]
+			time.sleep(0.3)
+			client.abort()
+			assert [ future.result() for future in futures ] == [None]*4
+		assert client.exchange([2], 0, timeout=5) == (2, 0)
+		assert client.multiplexed
+	finally:
+		client.close()
+		stop_server(server, thread)
+
+# Legacy server: answers the unknown commands with a failure, and the others with their code
+def legacy_server(listen, answer_unknown=True):
+	sock, _ = listen.accept()
+	while True:
+		cmd = sock.recv(1)
+		if not cmd: break
+		if cmd[0] in [4, 5]:
+			answer = {"success": True, "answer": cmd[0]}
+		elif answer_unknown:
+			answer = {"success": False, "error": ["unknown command"]}
+		else:
+			continue
+		serial = pickle.dumps(answer)
+		sock.sendall(len(serial).to_bytes(4, "big")+serial)
+	sock.close()
+
+def start_legacy_server(answer_unknown=True):
+	listen = socket.socket()
+	listen.bind(("127.0.0.1", 0))
+	listen.listen(1)
+	thread = threading.Thread(target=legacy_server, args=(listen, answer_unknown), daemon=True)
+	thread.start()
+	return listen, thread
+
+def test_negotiation_with_legacy_server():
+	listen, thread = start_legacy_server()
+	client = ClientSocket(negotiation=True)
+	try:
+		assert client.connect("127.0.0.1", listen.getsockname()[1])
+		assert client.legacy_peer and not client.framed
+		# The offer was not sent: the stream is in sync
+		assert client.exchange([4], timeout=5) == 4
+		assert client.exchange([5], timeout=5) == 5
+	finally:
+		client.close()
+		thread.join(timeout=5)
+		listen.close()
+
+def test_negotiation_timeout_is_not_legacy():
+	listen, thread = start_legacy_server(answer_unknown=False)
+	client = ClientSocket(negotiation=True)
+	try:
+		assert not client.connect("127.0.0.1", listen.getsockname()[1], timeout=1)
+		assert not client.legacy_peer and not client.connected()
+	finally:
+		client.close()
+		thread.join(timeout=5)
+		listen.close()
+
+def test_negotiation():
+	server, thread = start_server()
+	client = ClientSocket(negotiation=True)
+	try:
+		assert client.connect("127.0.0.1", server.port)
+		assert client.framed and not client.legacy_peer
+		assert client.exchange([2], {"x": bytes(10000)}, timeout=5) == (2, {"x": bytes(10000)})
+	finally:
+		client.close()
+		stop_server(server, thread)
+
+def unix_server(path):
+	server = ServerSocket(None, addr=path, socktype=socket.AF_UNIX, backlog=4)
+	assert server.bind()
+	thread = threading.Thread(target=server.serve, args=(handler, 4, 0.5), daemon=True)
+	thread.start()
+	return server, thread
+
+def test_shm_frames(tmp_path):
+	server, thread = unix_server(str(tmp_path/"sock"))
+	client = ClientSocket(socktype=socket.AF_UNIX, negotiation=True)
+	try:
+		assert client.connect(str(tmp_path/"sock"))
+		assert client.shm
+		data = {"a": bytes(range(256))*8192, "b": list(range(10))}
+		assert client.exchange([2], data, timeout=5) == (2, data)
+	finally:
+		client.close()
+		stop_server(server, thread)
+
+# The memory files which are not sealed, or smaller than the frame, are refused
+def test_shm_unsealed():
+	receiver = ClientSocket()
+	fd = os.memfd_create("test", os.MFD_ALLOW_SEALING)
+	os.write(fd, bytes(4096))
+	receiver.received_fds.append(fd)
+	assert receiver.map_shm(4096) is None
+	fd = os.memfd_create("test", os.MFD_ALLOW_SEALING)
+	os.write(fd, bytes(4096))
+	fcntl.fcntl(fd, fcntl.F_ADD_SEALS, SHM_SEALS)
+	receiver.received_fds.append(fd)
+	assert receiver.map_shm(8192) is None
+	fd = os.memfd_create("test", os.MFD_ALLOW_SEALING)
+	os.write(fd, bytes(4096))
+	fcntl.fcntl(fd, fcntl.F_ADD_SEALS, SHM_SEALS)
+	receiver.received_fds.append(fd)
+	assert receiver.map_shm(4096) == bytes(4096)
+
+# msgpack only encodes the objects it decodes as they are: the others fall back to pickle
+def test_msgpack_fallback():
+	pytest.importorskip("msgpack")
+	codec = CODECS["msgpack"]
+	assert codec.can_encode({"a": [1, 2.5, "x", b"y", None, True], 3: {"b": []}})
+	assert not codec.can_encode({"a": (1, 2)})
+	assert not codec.can_encode([{1, 2}])
+	assert not codec.can_encode([object()])
+	assert not codec.can_encode(2**64)
+	server, thread = start_server()
+	server.allowed_codecs = ["msgpack", "pickle"]
+	client = ClientSocket(negotiation=True)
+	client.allowed_codecs = ["msgpack", "pickle"]
+	try:
+		assert client.connect("127.0.0.1", server.port)
+		assert [ codec.name for codec in client.codecs ][0] == "msgpack"
+		assert client.exchange([2], {"x": [1, 2]}, timeout=5) == (2, {"x": [1, 2]})
+		assert client.exchange([2], {"x": (1, 2), "y": {3}}, timeout=5) == (2, {"x": (1, 2), "y": {3}})
+	finally:
+		client.close()
+		stop_server(server, thread)
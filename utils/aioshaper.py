@@ -0,0 +1,161 @@
+# External
+import asyncio, socket
+from collections import deque
+
+# Internal
+from common.utils.logs import *
+
+# Use uvloop as the asyncio event loop when it is installed
+# Return whether uvloop is used
+def install_uvloop():
+	try:
+		import uvloop
+	except ModuleNotFoundError:
+		return False
+	asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+	return True
+
+# Same relay as Shaper, as an asyncio protocol: many AsyncShapers share one event loop,
+# without thread nor wake socket.
+# The packets received are forwarded to the peer, which sends them to its UDP peer
+# (the last address it received a packet from, or the one set by prepare).
+class AsyncShaper(asyncio.DatagramProtocol):
+	def __init__(self, name="AsyncShaper", status_timeout=21600, max_packets=1024):
+		self.keep_running = False
+		self.name = name
+		self.log_component = "shaper."+name
+		self.loop = None
+		self.transport = None
+
+		# Status
+		self.status_timer = None
+		self.status_timeout = status_timeout
+
+		# Socket (given to the transport once prepared)
+		self.sock = None
+
+		# Peer's UDP host and port
+		self.udp_host = None
+		self.udp_port = None
+
+		# Local UDP host and port
+		self.udp_listen_host = None
+		self.udp_listen_port = None
+
+		# Peer
+		self.peer = None
+
+		# Messages forwarded before the UDP peer is known (at most max_packets)
+		self.sending_queue = deque(maxlen=max_packets)
+
+		# Counters
+		self.total_sent = 0
+		self.total_recv = 0
+		self.sent_packets = 0
+		self.recv_packets = 0
+		self.total_dropped = 0
+
+	def log(self, lev, *args, **kwargs):
+		if is_enabled(lev, self.log_component):
+			print_log(lev, "["+self.name+"]", *args, **kwargs)
+
+	# Abstract
+	def prepare(self):
+		pass
+
+	async def start(self, show_status=True):
+		self.loop = asyncio.get_running_loop()
+		self.keep_running = True
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.prepare()
+		self.sock.setblocking(False)
+		await self.loop.create_datagram_endpoint(lambda: self, sock=self.sock)
+
+		if show_status:
+			self.start_status_timer()
+
+	def stop(self):
+		self.keep_running = False
+		if self.status_timer is not None: self.status_timer.cancel()
+		if self.transport is not None: self.transport.close()
+
+	def set_peer(self, peer):
+		self.peer = peer
+
+	# May be called from any thread
+	def forward(self, packet):
+		if self.loop is None:
+			self.sending_queue.append(packet)
+			return
+		try:
+			running = asyncio.get_running_loop()
+		except RuntimeError:
+			running = None
+		if running is self.loop:
+			self.send(packet)
+		else:
+			self.loop.call_soon_threadsafe(self.send, packet)
+
+	def send(self, packet):
+		if self.transport is None or self.udp_host is None or self.udp_port is None:
+			if len(self.sending_queue) == self.sending_queue.maxlen:
+				self.total_dropped += 1
+			self.sending_queue.append(packet)
+			return
+		self.transport.sendto(packet, (self.udp_host, self.udp_port))
+		self.total_sent += len(packet)
+		self.sent_packets += 1
+
+	def flush(self):
+		while self.sending_queue and self.transport is not None and self.udp_host is not None:
+			self.send(self.sending_queue.popleft())
+
+	# asyncio.DatagramProtocol
+	def connection_made(self, transport):
+		self.transport = transport
+		self.flush()
+
+	def datagram_received(self, data, addr):
+		self.udp_host, self.udp_port = addr[0], addr[1]
+		if self.sending_queue:
+			# The UDP peer may just have been registered
+			self.flush()
+		if not data:
+			self.log(DEBUG, "datagram_received: received empty packet")
+			return
+		self.total_recv += len(data)
+		self.recv_packets += 1
+		try:
+			self.peer.forward(data)
+		except Exception as err:
+			self.log(ERROR, err)
+
+	def error_received(self, exc):
+		self.log(WARNING, "error_received:", exc)
+
+	def connection_lost(self, exc):
+		self.transport = None
+		if exc is not None:
+			self.log(ERROR, "connection_lost:", exc)
+
+	def start_status_timer(self):
+		self.status_timer = self.loop.call_later(self.status_timeout, self.status_routine)
+
+	def status_routine(self):
+		self.show_total()
+		if self.keep_running:
+			self.start_status_timer()
+
+	def show_total(self):
+		self.log(INFO, "AsyncShaper: sent: "+str(self.total_sent)+" bytes, received: "+str(self.total_recv)+" bytes")
+
+	def get_stats(self):
+		return {
+			"name": self.name,
+			"sent_packets": self.sent_packets,
+			"sent_bytes": self.total_sent,
+			"recv_packets": self.recv_packets,
+			"recv_bytes": self.total_recv,
+			"dropped": self.total_dropped,
+			"queue_packets": len(self.sending_queue)
+		}
@@ -0,0 +1,283 @@
+# External
+import asyncio, socket
+
+# Internal
+from common.utils.logs import *
+from common.utils.serializers import *
+from common.utils.sockets import *
+
+# asyncio counterparts of the ProtoSocket, ClientSocket and ServerSocket, on asyncio streams
+# The wire format is the same (legacy format, negotiation, codecs and compression), so they
+# interoperate with the blocking sockets, and many connections can share a single event loop.
+# The I/O methods are coroutines; the ones that do no I/O (compression, codecs, features)
+# are the ProtoSocket ones. Multiplexing, streams and shared memory are not supported.
+class AsyncProtoSocket(ProtoSocket):
+	def __init__(self):
+		ProtoSocket.__init__(self)
+		self.allow_multiplex = False
+		self.allow_shm = False
+		self.stream_reader = None
+		self.stream_writer = None
+
+	def set_streams(self, reader, writer):
+		self.stream_reader = reader
+		self.stream_writer = writer
+		self.socket = writer.get_extra_info("socket")
+		self.reset_features()
+
+	def close(self):
+		if self.stream_writer is not None: self.stream_writer.close()
+		self.stream_reader = None
+		self.stream_writer = None
+		self.socket = None
+		self.reset_features()
+
+	async def send_obj(self, obj):
+		if not self.connected():
+			log(ERROR, self.get_name()+".send_obj: Failed to send an object. The socket is not connected")
+			return 0
+		elif self.framed:
+			codec = self.pick_codec(obj)
+			tag, buffers = self.compress(codec.id, codec.encode(obj))
+			return await self.send_frame(tag, buffers)
+		else:
+			header, serial = serialize_frame(obj)
+			if header is None: return 0
+			return await self.send_buffers([header, serial])
+
+	async def recv_obj(self, timeout=30):
+		if self.framed:
+			frame = await self.recv_frame(timeout=timeout)
+			return None if frame is None else self.decode_frame(frame[0], frame[1])
+		bytlen = await self.recv_exact(OBJECT_SIZE, timeout=timeout)
+		if bytlen is not None:
+			bytobj = await self.recv_exact(bytes_to_int(bytlen), timeout=timeout)
+			if bytobj is not None:
+				return deserialize(bytobj)
+		return None
+
+	async def send_cmd(self, cmd):
+		if not self.connected():
+			log(ERROR, self.get_name()+".send_cmd: Failed to send a command. The socket is not connected")
+			return 0
+		return await self.send_buffers([ cmd_to_bytes(cmd) ])
+
+	async def recv_cmd(self, timeout=30):
+		if not self.connected():
+			log(ERROR, self.get_name()+".recv_cmd: Failed to receive a command. The socket is not connected")
+			return None
+		bytes_cmd = await self.recv_exact(COMMAND_SIZE, timeout=timeout)
+		if bytes_cmd is None: return None
+		cmd = bytes_to_int(bytes_cmd)
+		if cmd == CMD_NEGOTIATE:
+			# Handled here, the caller gets the next command
+			await self.accept_negotiation()
+			return await self.recv_cmd(timeout=timeout)
+		return cmd
+
+	async def send_frame(self, tag, buffers):
+		length = sum([ memoryview(buf).nbytes for buf in buffers ])
+		header = to_nb_bytes(length, OBJECT_SIZE)
+		if len(header) != OBJECT_SIZE: return 0
+		return await self.send_buffers([ header+tag.to_bytes(TAG_SIZE, 'big') ] + buffers)
+
+	# Return (tag, payload, None) or None, like ProtoSocket.recv_frame
+	async def recv_frame(self, timeout=30):
+		header = await self.recv_exact(OBJECT_SIZE+TAG_SIZE, timeout=timeout)
+		if header is None: return None
+		length = bytes_to_int(header[:OBJECT_SIZE])
+		tag = header[OBJECT_SIZE]
+		if tag & FLAG_REQUEST_ID or (tag & CODEC_MASK) not in CODECS_BY_ID:
+			log(ERROR, self.get_name()+".recv_frame: received an unsupported frame")
+			self.close()
+			return None
+		payload = await self.recv_exact(length, timeout=timeout)
+		if payload is None: return None
+		return tag, memoryview(payload), None
+
+	async def get_answer(self, timeout=30):
+		return self.parse_answer(await self.recv_obj(timeout=timeout))
+
+	# HCLIENT side (see ProtoSocket.negotiate)
+	async def negotiate(self, timeout=5):
+		if await self.send_cmd(CMD_NEGOTIATE) == 0: return False
+		ack = await self.recv_obj(timeout=timeout)
+		if ack is None:
+			log(WARNING, self.get_name()+".negotiate: no answer to the negotiation")
+			self.close()
+			return False
+		if not isinstance(ack, dict) or ack.get("answer") != NEGOTIATE_ACK:
+			log(WARNING, self.get_name()+".negotiate: the peer does not support the negotiation")
+			self.legacy_peer = True
+			return False
+		if await self.send_obj(self.offer_features()) <= 0:
+			return False
+		features = await self.get_answer(timeout=timeout)
+		if not isinstance(features, dict):
+			log(WARNING, self.get_name()+".negotiate: received an invalid answer to the offer")
+			self.close()
+			return False
+		self.apply_features(features)
+		return True
+
+	# HSERVER side (see ProtoSocket.accept_negotiation)
+	async def accept_negotiation(self):
+		if await self.send_obj({"success": True, "answer": NEGOTIATE_ACK}) <= 0:
+			return False
+		offer = await self.recv_obj()
+		if not isinstance(offer, dict):
+			log(ERROR, self.get_name()+".accept_negotiation: received an invalid offer")
+			self.close()
+			return False
+		features = self.accept_features(offer)
+		if await self.send_obj({"success": True, "answer": features}) <= 0:
+			return False
+		self.apply_features(features)
+		return True
+
+	async def send_buffers(self, buffers):
+		if not self.connected(): return 0
+		total = 0
+		try:
+			for buf in buffers:
+				self.stream_writer.write(buf)
+				total += memoryview(buf).nbytes
+			await self.stream_writer.drain()
+		except (ConnectionError, OSError):
+			log(WARNING, self.get_name()+".send_buffers: received a connection error")
+			self.close()
+			return 0
+		return total
+
+	# Receive exactly size bytes (bytes object), with a timeout, or None
+	async def recv_exact(self, size, timeout=30):
+		if not self.connected(): return None
+		try:
+			return await asyncio.wait_for(self.stream_reader.readexactly(size), timeout)
+		except asyncio.IncompleteReadError:
+			log(INFO, self.get_name()+".recv_exact: Connection terminated")
+		except asyncio.TimeoutError:
+			log(WARNING, self.get_name()+".recv_exact: reached timeout")
+		except (ConnectionError, OSError):
+			log(WARNING, self.get_name()+".recv_exact: received a connection error")
+		self.close()
+		return None
+
+
+class AsyncServerConnection(AsyncProtoSocket):
+	def __init__(self, server, reader, writer):
+		AsyncProtoSocket.__init__(self)
+		self.name = server.name
+		self.allowed_codecs = server.allowed_codecs
+		self.allowed_compressors = server.allowed_compressors
+		self.compress_threshold = server.compress_threshold
+		self.set_streams(reader, writer)
+		self.remaddr = writer.get_extra_info("peername")
+
+
+# Serve many clients from the event loop
+# handler(conn, cmd) is a coroutine called for each command received on a connection (an
+# AsyncServerConnection), which receives the data with recv_obj and answers with send_obj
+# The commands of a connection are handled one after the other
+class AsyncServerSocket(AsyncProtoSocket):
+	def __init__(self, port, addr="", reusable=False, backlog=100):
+		AsyncProtoSocket.__init__(self)
+		self.port = port
+		self.addr = addr
+		self.reusable = reusable
+		self.backlog = backlog
+		self.server = None
+		self.clients = set()
+
+	# Return whether the server listens
+	async def start(self, handler):
+		try:
+			self.server = await asyncio.start_server(
+				lambda reader, writer: self.handle_client(handler, reader, writer),
+				host=self.addr or None,
+				port=self.port,
+				reuse_address=self.reusable,
+				backlog=self.backlog
+			)
+		except OSError as err:
+			log(DEBUG, self.get_name()+".start: failed to bind socket:", err)
+			return False
+		self.port = self.server.sockets[0].getsockname()[1]
+		return True
+
+	async def serve_forever(self):
+		if self.server is not None:
+			await self.server.serve_forever()
+
+	def close(self):
+		if self.server is not None: self.server.close()
+		self.server = None
+		for conn in list(self.clients):
+			conn.close()
+
+	async def handle_client(self, handler, reader, writer):
+		conn = AsyncServerConnection(self, reader, writer)
+		self.clients.add(conn)
+		log(INFO, self.get_name()+".handle_client: accepted a new client ("+str(len(self.clients))+" connected)")
+		try:
+			while conn.connected():
+				cmd = await conn.recv_cmd(timeout=None)
+				if cmd is None: break
+				await handler(conn, cmd)
+		except Exception as err:
+			log(ERROR, self.get_name()+".handle_client: the handler failed:", err)
+		finally:
+			conn.close()
+			self.clients.discard(conn)
+
+	def nb_clients(self):
+		return len(self.clients)
+
+
+class AsyncClientSocket(AsyncProtoSocket):
+	def __init__(self, negotiation=False):
+		AsyncProtoSocket.__init__(self)
+		self.ip = None
+		self.port = None
+		self.negotiation = negotiation
+		self.legacy_peer = False
+
+	# ip and port are optional but need to be given at least for the first connection
+	async def connect(self, ip=None, port=None):
+		self.ip = self.ip if ip is None else ip
+		self.port = self.port if port is None else port
+		self.close()
+		try:
+			reader, writer = await asyncio.open_connection(self.ip, self.port)
+		except OSError:
+			return False
+		self.set_streams(reader, writer)
+		if self.negotiation and not self.legacy_peer and not await self.negotiate():
+			# Still open in the legacy format if the server does not support the negotiation
+			if self.legacy_peer: return self.connected()
+			self.close()
+			return False
+		return True
+
+	# Same as ClientSocket.exchange
+	async def exchange(self, commands=[], data=None, timeout=30, retry=1):
+		res = None
+		trials = 0
+		reconnect = False
+		while trials <= retry:
+			trials += 1
+			if reconnect:
+				if not await self.connect(): return None
+				reconnect = False
+			for cmd in commands:
+				if await self.send_cmd(cmd) == 0:
+					reconnect = True
+					break
+			else:
+				if data is not None and await self.send_obj(data) <= 0:
+					reconnect = True
+					continue
+				res = await self.get_answer(timeout=timeout)
+				if res is None: reconnect = True
+				else: break
+		return res
@@ -0,0 +1,210 @@
+# External
+import mmap, socket, struct, time
+
+# Internal
+from common.utils.logs import *
+
+# Capture ring file
+#
+# The file starts with a header, followed by a data area used as a ring buffer of records:
+#	Header: magic, version, data size, head (next write offset), tail (oldest record
+#	offset), number of records in the ring, sequence number of the next record, generation
+#	Record: length (whole record), sequence number, timestamp, direction, address length,
+#	port, original payload length, address (text), payload (truncated to snaplen)
+# A record never wraps: when it does not fit at the end of the data area, a zero length
+# is written (when there is room for it) and the record is written at the beginning.
+# The oldest records are overwritten when the ring is full.
+#
+# The ring may be read while it is written (seqlock): the generation is odd while the
+# header is updated, and the evicted records are removed from the header before being
+# overwritten. A reader copies a record, then checks in the header that it was not
+# evicted in the meantime.
+CAPTURE_MAGIC = b"HWCAPRNG"
+CAPTURE_VERSION = 2
+HEADER = struct.Struct("<8sIQQQQQQ")
+GENERATION = struct.Struct("<Q")
+GENERATION_OFFSET = HEADER.size-GENERATION.size
+RECORD = struct.Struct("<IQdBBHI")
+LENGTH = struct.Struct("<I")
+
+# Directions
+CAPTURE_IN = 0 # Received by the Shaper
+CAPTURE_OUT = 1 # Sent by the Shaper
+
+# A ring is written by a single thread (share it only between Shapers of the same engine)
+class CaptureRing:
+	def __init__(self, path, size=64*1024*1024, snaplen=65535):
+		self.path = path
+		self.size = size
+		self.snaplen = min(snaplen, size-RECORD.size-64)
+		self.file = open(path, "w+b")
+		self.file.truncate(HEADER.size+size)
+		self.map = mmap.mmap(self.file.fileno(), HEADER.size+size)
+		self.data = memoryview(self.map)[HEADER.size:]
+		self.head = 0
+		self.tail = 0
+		self.count = 0
+		self.seq = 0
+		self.generation = 0
+		self.dropped = 0
+		self.write_header()
+
+	def close(self):
+		if self.map is None: return
+		self.data.release()
+		self.map.close()
+		self.file.close()
+		self.map = None
+
+	# The header is copied rather than packed in place: pack_into clears the bytes first,
+	# which would expose a zero (even) generation to the readers
+	def write_header(self):
+		self.generation += 1
+		self.map[GENERATION_OFFSET:HEADER.size] = GENERATION.pack(self.generation)
+		self.map[:GENERATION_OFFSET] = HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, self.size, self.head, self.tail, self.count, self.seq, self.generation)[:GENERATION_OFFSET]
+		self.generation += 1
+		self.map[GENERATION_OFFSET:HEADER.size] = GENERATION.pack(self.generation)
+
+	# Evict the oldest records starting in [start, end)
+	def reserve(self, start, end):
+		while self.count > 0 and start <= self.tail < end:
+			length = LENGTH.unpack_from(self.data, self.tail)[0] if self.tail+LENGTH.size <= self.size else 0
+			if length == 0:
+				self.tail = 0 # Wrap marker
+				continue
+			self.tail += length
+			self.count -= 1
+			if self.tail >= self.size:
+				self.tail = 0
+
+	# Append a packet to the ring (never blocks: the oldest records are overwritten)
+	def write(self, direction, host, port, payload):
+		if self.map is None:
+			self.dropped += 1
+			return False
+		addr = str(host).encode()[:255]
+		data = payload[:self.snaplen]
+		length = RECORD.size+len(addr)+len(data)
+
+		count = self.count
+		wrap = self.head+length > self.size # Not enough room at the end of the data area
+		if wrap:
+			self.reserve(self.head, self.size)
+			if self.count == 0: self.tail = 0
+		start = 0 if wrap else self.head
+		self.reserve(start, start+length)
+		if self.count < count:
+			# The readers must see the evicted records gone before they are overwritten
+			self.write_header()
+		if wrap:
+			if self.head+LENGTH.size <= self.size:
+				LENGTH.pack_into(self.data, self.head, 0)
+			self.head = 0
+		if self.count == 0: self.tail = self.head
+
+		off = self.head
+		RECORD.pack_into(self.data, off, length, self.seq, time.time(), direction, len(addr), port or 0, len(payload))
+		off += RECORD.size
+		self.data[off:off+len(addr)] = addr
+		off += len(addr)
+		self.data[off:off+len(data)] = data
+
+		self.head += length
+		if self.head >= self.size: self.head = 0
+		self.count += 1
+		self.seq += 1
+		self.write_header()
+		return True
+
+# Read a consistent header: (magic, version, size, head, tail, count, seq)
+def read_header(ring):
+	for _ in range(1000):
+		generation = GENERATION.unpack_from(ring, GENERATION_OFFSET)[0]
+		header = HEADER.unpack_from(ring, 0)
+		if generation % 2 == 0 and GENERATION.unpack_from(ring, GENERATION_OFFSET)[0] == generation:
+			break
+		time.sleep(0) # Being updated
+	return header[:-1]
+
+# Copy the record at off
+# Return (offset of the next record, record), or None if the record is invalid
+def read_record(ring, size, off):
+	if off+LENGTH.size > size or LENGTH.unpack_from(ring, HEADER.size+off)[0] == 0:
+		off = 0
+	if off+RECORD.size > size: return None
+	length, seq, stamp, direction, addrlen, port, origlen = RECORD.unpack_from(ring, HEADER.size+off)
+	if length < RECORD.size+addrlen or off+length > size:
+		return None
+	start = HEADER.size+off+RECORD.size
+	host = ring[start:start+addrlen].decode(errors="replace")
+	payload = ring[start+addrlen:HEADER.size+off+length]
+	off += length
+	if off >= size: off = 0
+	return off, (seq, stamp, direction, host, port, origlen, payload)
+
+# Read the records of a capture ring file, from the oldest to the newest
+# Yield (sequence number, timestamp, direction, host, port, original length, payload)
+# If after is given, only the records with a greater sequence number are returned
+# The records overwritten while they are read are skipped
+def read_capture(path, after=None):
+	with open(path, "rb") as file:
+		with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as ring:
+			magic, version, size, head, tail, count, end = read_header(ring)
+			if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+				log(ERROR, "common.utils.capture.read_capture: invalid capture file")
+				return
+			# The records written after this point are not read
+			expected = end-count
+			off = tail
+			while expected < end:
+				res = read_record(ring, size, off)
+				_, _, _, _, tail, count, seq = read_header(ring)
+				oldest = seq-count
+				if res is not None and res[1][0] == expected and expected >= oldest:
+					off, record = res
+					if after is None or expected > after:
+						yield record
+					expected += 1
+				elif expected >= oldest:
+					log(ERROR, "common.utils.capture.read_capture: corrupted record")
+					return
+				else:
+					# Overwritten while being read: resume from the oldest record
+					expected = oldest
+					off = tail
+
+# Stream the records of a capture ring file as they are written
+# The file is polled every interval seconds; records overwritten before being read are lost
+def follow_capture(path, interval=1):
+	last = None
+	while True:
+		for record in read_capture(path, after=last):
+			last = record[0]
+			yield record
+		time.sleep(interval)
+
+# Convert a capture ring file to a pcap file (raw IPv4/UDP packets, the local address
+# being given by local_host and local_port)
+def capture_to_pcap(path, out, local_host="0.0.0.0", local_port=0):
+	with open(out, "wb") as pcap:
+		pcap.write(struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 101)) # LINKTYPE_RAW
+		for _, stamp, direction, host, port, origlen, payload in read_capture(path):
+			try:
+				remote = socket.inet_aton(host)
+			except OSError:
+				continue # Not an IPv4 address
+			local = socket.inet_aton(local_host)
+			src, dst = (remote, local) if direction == CAPTURE_IN else (local, remote)
+			sport, dport = (port, local_port) if direction == CAPTURE_IN else (local_port, port)
+			udp = struct.pack("!HHHH", sport, dport, 8+len(payload), 0)
+			ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20+len(udp)+len(payload), 0, 0, 64, socket.IPPROTO_UDP, 0, src, dst)
+			ip = ip[:10]+struct.pack("!H", ip_checksum(ip))+ip[12:]
+			packet = ip+udp+payload
+			pcap.write(struct.pack("<IIII", int(stamp), int((stamp%1)*1000000), len(packet), 28+origlen))
+			pcap.write(packet)
+
+def ip_checksum(header):
+	total = sum(struct.unpack("!10H", header))
+	while total > 0xffff:
+		total = (total & 0xffff)+(total >> 16)
+	return ~total & 0xffff
@@ -1,9 +1,138 @@
+# External
+import threading, time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Internal
+from common.utils.instrument import instrumentation
+from common.utils.logs import *
+from common.utils.sockets import RequestSocket
+
+# Run func in a worker, return its result and duration (module level to be picklable)
+def timed_call(func, args, kwargs):
+	start = time.perf_counter()
+	res = func(*args, **kwargs)
+	return res, time.perf_counter()-start
+
+# Command handled by the workers of a Controller (see Controller.dispatch)
+class ControllerTask:
+	def __init__(self, cmd, func, args, kwargs, request_id):
+		self.cmd = cmd
+		self.func = func
+		self.args = args
+		self.kwargs = kwargs
+		self.request_id = request_id # Request of a multiplexed connection (None otherwise)
+		self.cache_key = None
+		self.generation = 0
+		self.group = None
+		self.timer = None
+		self.answered = False
+		self.lock = threading.Lock()
+
+	# Only the first of the result and the deadline answers
+	def claim(self):
+		with self.lock:
+			if self.answered: return False
+			self.answered = True
+			return True
+
+# Answers of the cacheable commands, by command and arguments
+# Each command has a TTL and a maximum number of entries (the least recently used ones are
+# evicted). Invalidating a command drops its entries and increments its generation: the
+# results of the calls started before are then not cached.
+class ResultCache:
+	def __init__(self):
+		self.policies = {} # Command -> (ttl, maxsize)
+		self.entries = {} # Command -> OrderedDict: key -> (expiration time, answer)
+		self.generations = {} # Command -> generation
+		self.hits = {}
+		self.misses = {}
+		self.invalidations = {}
+		self.lock = threading.Lock()
+
+	def set_policy(self, cmd, ttl, maxsize):
+		with self.lock:
+			self.policies[cmd] = (ttl, maxsize)
+			self.entries.setdefault(cmd, OrderedDict())
+
+	# Return the key of a call, or None if it cannot be cached
+	def make_key(self, cmd, args, kwargs):
+		if cmd not in self.policies: return None
+		key = (tuple(args), frozenset(kwargs.items()))
+		try:
+			hash(key)
+		except TypeError:
+			return None
+		return key
+
+	def generation(self, cmd):
+		return self.generations.get(cmd, 0)
+
+	# Return the cached answer, or None
+	def get(self, cmd, key):
+		with self.lock:
+			entries = self.entries[cmd]
+			entry = entries.get(key)
+			if entry is not None and entry[0] < time.monotonic():
+				del entries[key]
+				entry = None
+			if entry is None:
+				self.misses[cmd] = self.misses.get(cmd, 0)+1
+				return None
+			entries.move_to_end(key)
+			self.hits[cmd] = self.hits.get(cmd, 0)+1
+			return entry[1]
+
+	def put(self, cmd, key, res, generation):
+		with self.lock:
+			if generation != self.generation(cmd): return # Invalidated in the meantime
+			ttl, maxsize = self.policies[cmd]
+			entries = self.entries[cmd]
+			entries[key] = (time.monotonic()+ttl, res)
+			entries.move_to_end(key)
+			while len(entries) > maxsize:
+				entries.popitem(last=False)
+
+	# Invalidate the given commands (all of them if cmds is None)
+	def invalidate(self, cmds=None):
+		with self.lock:
+			for cmd in list(self.policies) if cmds is None else cmds:
+				if cmd not in self.policies: continue
+				self.entries[cmd].clear()
+				self.generations[cmd] = self.generation(cmd)+1
+				self.invalidations[cmd] = self.invalidations.get(cmd, 0)+1
+
+	def get_stats(self):
+		with self.lock:
+			return {
+				cmd: {
+					"entries": len(self.entries[cmd]),
+					"hits": self.hits.get(cmd, 0),
+					"misses": self.misses.get(cmd, 0),
+					"invalidations": self.invalidations.get(cmd, 0)
+				} for cmd in self.policies
+			}
+
 class Controller:
 	def __init__(self):
 		self.socket = None
 		self.name = None
 
+		# Dispatch mode (see start_workers)
+		self.executor = None
+		self.deadlines = {} # Command -> seconds to answer
+		self.default_deadline = None
+		self.conflicts = {} # Command -> conflict group
+		self.group_queues = {} # Conflict group -> tasks waiting (the first one is running)
+		self.tasks_lock = threading.Lock()
+
+		# Cached answers (see set_cacheable)
+		self.cache = ResultCache()
+		self.invalidations = {} # Command -> commands whose answers it invalidates
+		self.phase_dependent = None # Commands whose answers depend on the phase (None for all)
+
 	def __del__(self):
+		self.stop_workers()
 		del self.socket
 
 	# Get the class name to generate logs (this class is abstract)
@@ -20,10 +149,178 @@ class Controller:
 	#	"success" (mandatory): boolean that indicates whether the function succeeded or not
 	#	"answer" (optional): answer object in case of success
 	#	INFO/ERROR/WARNING/FATAL (optional): message for the client
+	# In dispatch mode, func is run by a worker and the result is sent when it completes
 	def exec(self, func, *args, **kwargs):
+		if self.executor is not None:
+			return self.dispatch(None, func, *args, **kwargs)
 		res = func(*args, **kwargs)
 		if self.socket.send_obj(res) <= 0:
 			if self.reconnect():
 				if self.socket.send_obj(res) > 0:
 					return True
-		return False
\ No newline at end of file
+		return False
+
+	# Same as exec, for the command cmd: in dispatch mode, its deadline and conflicts apply
+	# The answers of the cacheable commands are sent from the cache when possible, and the
+	# commands changing the state invalidate the cached answers depending on it
+	def exec_cmd(self, cmd, func, *args, **kwargs):
+		key = self.cache.make_key(cmd, args, kwargs)
+		if key is not None:
+			res = self.cache.get(cmd, key)
+			if res is not None:
+				if instrumentation.enabled: instrumentation.record(cmd, cache_hits=1)
+				return self.send_answer(res, self.current_request_id(), cmd)
+		if cmd in self.invalidations:
+			self.cache.invalidate(self.invalidations[cmd])
+		if self.executor is not None:
+			return self.dispatch(cmd, func, *args, **kwargs)
+		res = self.run_cmd(cmd, key, self.cache.generation(cmd), func, args, kwargs)
+		return self.send_answer(res, self.current_request_id(), cmd)
+
+	def run_cmd(self, cmd, key, generation, func, args, kwargs):
+		res, duration = timed_call(func, args, kwargs)
+		if instrumentation.enabled: instrumentation.record(cmd, handler_time=duration)
+		self.cmd_done(cmd, key, generation, res)
+		return res
+
+	# Cache the answer, and invalidate the answers computed while the state was changing
+	def cmd_done(self, cmd, key, generation, res):
+		if key is not None and isinstance(res, dict) and res.get("success"):
+			self.cache.put(cmd, key, res, generation)
+		if cmd in self.invalidations:
+			self.cache.invalidate(self.invalidations[cmd])
+
+	# Cache the successful answers of cmd for ttl seconds (at most maxsize different arguments)
+	def set_cacheable(self, cmd, ttl=5, maxsize=128):
+		self.cache.set_policy(cmd, ttl, maxsize)
+
+	# table: command -> commands whose cached answers it invalidates (e.g. VM_INVALIDATIONS)
+	def set_invalidations(self, table, phase_dependent=None):
+		self.invalidations = table
+		self.phase_dependent = phase_dependent
+
+	def invalidate(self, cmds=None):
+		self.cache.invalidate(cmds)
+
+	# To call when the phase changes (e.g. from COMMIT_PHASE to RUN_PHASE)
+	def phase_changed(self):
+		self.cache.invalidate(self.phase_dependent)
+
+	def get_cache_stats(self):
+		return self.cache.get_stats()
+
+	def current_request_id(self):
+		return self.socket.request_id if self.socket is not None and self.socket.multiplexed else None
+
+	# Dispatch mode: the commands are run by a pool of workers (processes=True for a
+	# process pool: func and its arguments must then be picklable), so that a slow command
+	# does not block the others. The results are sent as they complete: the answers of a
+	# multiplexed connection carry the identifier of their request, while a lock-step
+	# client only sends a command once the previous one is answered.
+	def start_workers(self, workers=4, processes=False):
+		if self.executor is not None: return
+		self.executor = ProcessPoolExecutor(max_workers=workers) if processes else ThreadPoolExecutor(max_workers=workers)
+
+	def stop_workers(self, wait=True):
+		executor, self.executor = self.executor, None
+		if executor is not None: executor.shutdown(wait=wait)
+
+	# A command not answered within seconds gets a failure answer (its result is dropped)
+	def set_deadline(self, cmd, seconds):
+		self.deadlines[cmd] = seconds
+
+	# Commands run one after the other (in the order they were received), e.g. CMD_VM_WG_UP
+	# and CMD_VM_WG_DOWN; the other commands run concurrently
+	def declare_conflict(self, *cmds):
+		group = frozenset(cmds)
+		for cmd in cmds:
+			self.conflicts[cmd] = group
+
+	# Return True once the command is submitted
+	def dispatch(self, cmd, func, *args, **kwargs):
+		task = ControllerTask(cmd, func, args, kwargs, self.current_request_id())
+		task.cache_key = self.cache.make_key(cmd, args, kwargs)
+		task.generation = self.cache.generation(cmd)
+		deadline = self.deadlines.get(cmd, self.default_deadline)
+		if deadline is not None:
+			task.timer = threading.Timer(deadline, self.deadline_exceeded, args=(task, deadline))
+			task.timer.daemon = True
+			task.timer.start()
+		task.group = self.conflicts.get(cmd)
+		if task.group is not None:
+			with self.tasks_lock:
+				queue = self.group_queues.setdefault(task.group, deque())
+				queue.append(task)
+				if len(queue) > 1: return True # Run when the previous ones complete
+		self.run_task(task)
+		return True
+
+	def run_task(self, task):
+		try:
+			future = self.executor.submit(timed_call, task.func, task.args, task.kwargs)
+		except Exception as err:
+			log(ERROR, self.get_name()+".run_task: failed to submit the command:", err)
+			self.task_done(task, {"success": False, ERROR: ["the command could not be run"]})
+			return
+		future.add_done_callback(lambda future: self.task_completed(task, future))
+
+	def task_completed(self, task, future):
+		err = future.exception()
+		if err is not None:
+			log(ERROR, self.get_name()+".task_completed: the command failed:", err)
+			res = {"success": False, ERROR: ["the command failed: "+str(err)]}
+		else:
+			res, duration = future.result()
+			if task.cmd is not None and instrumentation.enabled:
+				instrumentation.record(task.cmd, handler_time=duration)
+		self.cmd_done(task.cmd, task.cache_key, task.generation, res)
+		self.task_done(task, res)
+
+	def task_done(self, task, res):
+		if task.timer is not None: task.timer.cancel()
+		if task.claim():
+			self.send_answer(res, task.request_id, task.cmd)
+		if task.group is not None:
+			with self.tasks_lock:
+				queue = self.group_queues[task.group]
+				queue.popleft()
+				following = queue[0] if queue else None
+			if following is not None:
+				self.run_task(following)
+
+	def deadline_exceeded(self, task, deadline):
+		if task.claim():
+			log(WARNING, self.get_name()+".deadline_exceeded: command "+str(task.cmd)+" not completed within "+str(deadline)+" seconds")
+			self.send_answer({"success": False, ERROR: ["the command did not complete within "+str(deadline)+" seconds"]}, task.request_id, task.cmd)
+
+	# Send the result of a command (from any thread)
+	# The answers of the command cmd are recorded by the instrumentation (the encoding time
+	# of the answers sent concurrently by other workers may be counted in each other)
+	def send_answer(self, res, request_id=None, cmd=None):
+		sock = self.socket
+		encode_time = sock.encode_time if sock is not None else 0
+		sent = self.send_result(res, request_id)
+		if cmd is not None and instrumentation.enabled:
+			instrumentation.record(cmd,
+				calls=1,
+				errors=int(sent <= 0 or not (isinstance(res, dict) and res.get("success"))),
+				serialize_time=sock.encode_time-encode_time if sock is not None else 0,
+				sent_bytes=sent
+			)
+		return sent > 0
+
+	# Return the number of bytes sent
+	def send_result(self, res, request_id=None):
+		sock = self.socket if request_id is None else RequestSocket(self.socket, request_id, [], None)
+		sent = sock.send_obj(res) if sock is not None else 0
+		if sent > 0: return sent
+		# The request of a multiplexed connection is lost with the connection
+		if request_id is None and self.reconnect():
+			return self.socket.send_obj(res)
+		return 0
+
+	# Answer of a command dumping the instrumentation (see utils/instrument.py)
+	def get_metrics(self, text=False):
+		if text:
+			return {"success": True, "answer": instrumentation.dump()}
+		return {"success": True, "answer": instrumentation.get_stats()}
@@ -0,0 +1,98 @@
+# External
+import threading, time
+from concurrent.futures import TimeoutError as FutureTimeout
+
+# Internal
+from common.utils.logs import *
+from common.vm.proto import CMD_VM_LIVE
+
+# Heartbeats on the connection of a ProtoSocket (HCLIENT side, e.g. a ClientSocket or the
+# ServerSocket of a TSERVER+HCLIENT), to detect dead peers
+# within a few intervals instead of waiting for the timeouts of the exchanges
+#
+# Every interval seconds without traffic, the live command is sent: the peer is dead if it
+# does not answer within timeout seconds (any answer, even a failure, means it is alive).
+# The connection is then aborted, so that the exchanges in flight fail right away (and
+# reconnect), and on_dead(sock) is called.
+# A lock-step connection cannot be pinged while an exchange is running (the HCLIENT holds
+# the exchange lock of the socket until it gets the answer): TCP keepalive
+# (enabled on the connection by default) watches it in the meantime. Multiplexed
+# connections are pinged even while exchanges are in flight.
+class Heartbeat:
+	def __init__(self, sock, interval=1, timeout=3, cmd=CMD_VM_LIVE, on_dead=None, keepalive=True):
+		self.socket = sock
+		self.interval = interval
+		self.timeout = timeout
+		self.cmd = cmd
+		self.on_dead = on_dead
+		self.thread = None
+		self.stop_event = threading.Event()
+
+		# Counters
+		self.pings = 0
+		self.deaths = 0
+		self.last_rtt = None
+
+		if keepalive:
+			sock.set_keepalive(idle=interval, interval=interval, count=max(1, int(timeout/interval)), user_timeout=timeout)
+
+	def get_name(self):
+		return self.socket.get_name()+".heartbeat"
+
+	def start(self):
+		self.stop_event.clear()
+		self.thread = threading.Thread(target=self.routine, name=self.get_name(), daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.stop_event.set()
+		if self.thread is not None and self.thread is not threading.current_thread():
+			self.thread.join()
+		self.thread = None
+
+	def routine(self):
+		while not self.stop_event.wait(self.interval):
+			if not self.socket.connected(): continue # Reopened by the next exchange
+			if time.monotonic()-self.socket.last_recv < self.interval: continue # Recent traffic
+			alive = self.ping()
+			if alive is False:
+				self.peer_dead()
+
+	# Return whether the peer answered (None if it could not be pinged)
+	def ping(self):
+		sock = self.socket
+		start = time.monotonic()
+		if sock.multiplexed:
+			try:
+				res = sock.submit([self.cmd]).result(timeout=self.timeout)
+			except FutureTimeout:
+				res = None
+		elif sock.exchange_lock.acquire(blocking=False):
+			try:
+				res = sock.request_once([self.cmd], timeout=self.timeout)
+			finally:
+				sock.exchange_lock.release()
+		else:
+			return None # An exchange is running
+		self.pings += 1
+		if res is None: return False
+		self.last_rtt = time.monotonic()-start
+		return True
+
+	def peer_dead(self):
+		self.deaths += 1
+		log(WARNING, self.get_name()+": the peer did not answer within "+str(self.timeout)+" seconds")
+		self.socket.abort()
+		if self.on_dead is not None:
+			try:
+				self.on_dead(self.socket)
+			except Exception as err:
+				log(ERROR, self.get_name()+": on_dead failed:", err)
+
+	def get_stats(self):
+		return {
+			"pings": self.pings,
+			"deaths": self.deaths,
+			"last_rtt": self.last_rtt,
+			"last_recv_age": time.monotonic()-self.socket.last_recv if self.socket.last_recv else None
+		}
@@ -0,0 +1,132 @@
+# External
+import threading
+
+# Internal
+from common.utils.logs import *
+from common.utils.metrics import Histogram, render_prometheus, write_atomic
+from common.vm.proto import VM_COMMANDS
+
+# Buckets for message sizes, in bytes (from 64B to 16MB)
+SIZE_BUCKETS = [ 64 * 4**i for i in range(10) ]
+
+# Metrics of one command code
+class CommandMetrics:
+	def __init__(self, name):
+		self.name = name
+		self.calls = 0
+		self.errors = 0
+		self.cache_hits = 0
+		self.sent_bytes = 0
+		self.recv_bytes = 0
+		self.handler_time = Histogram() # HSERVER: time spent running the command
+		self.serialize_time = Histogram() # Time spent encoding the objects sent
+		self.round_trip = Histogram() # HCLIENT: time from the command to its answer
+		self.message_size = Histogram(SIZE_BUCKETS) # Bytes sent and received per call
+
+	def get(self):
+		return {
+			"name": self.name,
+			"calls": self.calls,
+			"errors": self.errors,
+			"cache_hits": self.cache_hits,
+			"sent_bytes": self.sent_bytes,
+			"recv_bytes": self.recv_bytes,
+			"handler_time": self.handler_time.get(),
+			"serialize_time": self.serialize_time.get(),
+			"round_trip": self.round_trip.get(),
+			"message_size": self.message_size.get()
+		}
+
+# Per-command metrics, recorded by ClientSocket.exchange (HCLIENT side) and
+# Controller.exec_cmd (HSERVER side)
+# Recording costs a lock and a few bucket lookups; hooks are called with
+# (command name, metric, value) for every value recorded, to feed custom sinks.
+class Instrumentation:
+	def __init__(self, commands=VM_COMMANDS):
+		self.enabled = True
+		self.names = {}
+		self.commands = {} # Command code -> CommandMetrics
+		self.hooks = []
+		self.lock = threading.Lock()
+		self.set_names(commands)
+
+	# commands: name -> code (e.g. VM_COMMANDS)
+	def set_names(self, commands):
+		self.names = { code: name for name, code in commands.items() }
+
+	def get_name(self, cmd):
+		return self.names.get(cmd, "CMD_"+str(cmd))
+
+	def add_hook(self, hook):
+		self.hooks += [ hook ]
+
+	def remove_hook(self, hook):
+		self.hooks = [ other for other in self.hooks if other is not hook ]
+
+	# Record values for a command, e.g. record(cmd, calls=1, round_trip=0.002, sent_bytes=120)
+	# Counters (calls, errors, cache_hits, sent_bytes, recv_bytes) are added, durations
+	# (handler_time, serialize_time, round_trip) are observed by histograms
+	def record(self, cmd, **values):
+		with self.lock:
+			metrics = self.commands.get(cmd)
+			if metrics is None:
+				metrics = CommandMetrics(self.get_name(cmd))
+				self.commands[cmd] = metrics
+			for metric, value in values.items():
+				if metric in ["handler_time", "serialize_time", "round_trip"]:
+					getattr(metrics, metric).observe(value)
+				else:
+					setattr(metrics, metric, getattr(metrics, metric)+value)
+					if metric in ["sent_bytes", "recv_bytes"]:
+						metrics.message_size.observe(value)
+		# A failing hook must not break the caller (e.g. a controller answering a command)
+		for hook in self.hooks:
+			try:
+				for metric, value in values.items():
+					hook(metrics.name, metric, value)
+			except Exception as err:
+				log(ERROR, "Instrumentation.record: the hook "+str(hook)+" failed:", err)
+
+	def reset(self):
+		with self.lock:
+			self.commands = {}
+
+	def get_stats(self):
+		with self.lock:
+			return { metrics.name: metrics.get() for metrics in self.commands.values() }
+
+	def metrics(self):
+		with self.lock:
+			commands = list(self.commands.values())
+		res = []
+		for metric, doc in [("calls", "Commands handled or sent"), ("errors", "Commands failed"),
+				("cache_hits", "Commands answered from the cache"),
+				("sent_bytes", "Bytes sent for the commands"), ("recv_bytes", "Bytes received for the commands")]:
+			res += [ ("honeywalt_command_"+metric+"_total", "counter", doc, [ ({"command": m.name}, getattr(m, metric)) for m in commands ]) ]
+		for metric, doc in [("handler_time", "Time spent running the commands"),
+				("serialize_time", "Time spent encoding the objects sent"),
+				("round_trip", "Time from a command to its answer")]:
+			res += [ ("honeywalt_command_"+metric+"_seconds", "histogram", doc, [ ({"command": m.name}, getattr(m, metric)) for m in commands ]) ]
+		res += [ ("honeywalt_command_message_bytes", "histogram", "Bytes sent or received per command", [ ({"command": m.name}, m.message_size) for m in commands ]) ]
+		return res
+
+	# Dump the metrics: a table (text=True) or the Prometheus text format
+	# Written atomically to path when given, returned otherwise
+	def dump(self, path=None, text=True):
+		if text:
+			lines = [ "command".ljust(20)+"calls".rjust(8)+"errors".rjust(8)+"hits".rjust(8)+"p50(ms)".rjust(10)+"p99(ms)".rjust(10)+"handler(ms)".rjust(12)+"encode(ms)".rjust(11)+"sent".rjust(12)+"recv".rjust(12) ]
+			for name, stats in sorted(self.get_stats().items()):
+				lines += [ name.ljust(20)+str(stats["calls"]).rjust(8)+str(stats["errors"]).rjust(8)+str(stats["cache_hits"]).rjust(8)
+					+format_ms(stats["round_trip"]["p50"]).rjust(10)+format_ms(stats["round_trip"]["p99"]).rjust(10)
+					+format_ms(stats["handler_time"]["p50"]).rjust(12)+format_ms(stats["serialize_time"]["p50"]).rjust(11)
+					+str(stats["sent_bytes"]).rjust(12)+str(stats["recv_bytes"]).rjust(12) ]
+			res = "\n".join(lines)+"\n"
+		else:
+			res = render_prometheus(self.metrics())
+		if path is None: return res
+		write_atomic(path, res)
+
+def format_ms(value):
+	return "-" if value is None else "%.3f" % (value*1000)
+
+instrumentation = Instrumentation() # Shared by the sockets and controllers of the process
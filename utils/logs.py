@@ -10,6 +10,12 @@ WARNING = 2
 ERROR = 1
 FATAL = 0
 
+LEVEL_NAMES = { FATAL: "FATAL", ERROR: "ERROR", WARNING: "WARNING", INFO: "INFO", COMMAND: "COMMAND", DEBUG: "DEBUG" }
+
+# Per-component levels overriding LOG_LEVEL (see set_component_level)
+COMPONENT_LEVELS = {}
+COMPONENT_CACHE = {} # Component -> resolved level
+
 def get_trace(start_func="main", nb_off=2):
 	calls = []
 	start = False
@@ -26,23 +32,59 @@ def eprint(*args, **kwargs):
     log(FATAL, *args, **kwargs)
     sys.exit(1)
 
-def log(level, *args, **kwargs):
-	if level <= LOG_LEVEL:
-		if level == FATAL:
-			#trace = get_trace(nb_off=3)+":"
-			print("[FATAL]", *args, file=sys.stderr, flush=True, **kwargs)
-		elif level == ERROR:
-			#trace = get_trace(nb_off=3)+":"
-			print("[ERROR]", *args, file=sys.stderr, flush=True, **kwargs)
-		elif level == WARNING:
-			#trace = get_trace()+":"
-			print("[WARNING]", *args, flush=True, **kwargs)
-		elif level == INFO:
-			print("[INFO]", *args, flush=True, **kwargs)
-		elif level == DEBUG:
-			print("[DEBUG]", *args, flush=True, **kwargs)
-		elif level == COMMAND:
-			print("[COMMAND]", *args, flush=True, **kwargs)
+# Level of a component: its override, or the one of its closest parent ("shaper" for
+# "shaper.relay1"), or LOG_LEVEL
+def get_component_level(component):
+	level = COMPONENT_CACHE.get(component)
+	if level is None:
+		parent = component
+		while parent not in COMPONENT_LEVELS and "." in parent:
+			parent = parent.rsplit(".", 1)[0]
+		level = COMPONENT_LEVELS.get(parent, LOG_LEVEL)
+		COMPONENT_CACHE[component] = level
+	return level
+
+# Whether a message of the given level would be emitted (for the given component)
+# Cheap enough for the hot paths: check it before building the arguments of a message
+def is_enabled(level, component=None):
+	if component is None or not COMPONENT_LEVELS:
+		return level <= LOG_LEVEL
+	return level <= get_component_level(component)
+
+def log(level, *args, component=None, **kwargs):
+	if is_enabled(level, component):
+		print_log(level, *args, **kwargs)
+
+# Same as log, with a message formatted only when emitted: msg is a %-style format (with
+# args), or a function returning the message, e.g.:
+#	logf(DEBUG, "received %d bytes from %s", size, addr)
+#	logf(DEBUG, lambda: "queue: "+str(list(queue)))
+def logf(level, msg, *args, component=None, **kwargs):
+	if is_enabled(level, component):
+		print_log(level, format_log(msg, args), **kwargs)
+
+def format_log(msg, args):
+	if callable(msg):
+		return msg()
+	return msg % args if args else msg
+
+# Print a message without checking its level
+def print_log(level, *args, **kwargs):
+	if level == FATAL:
+		#trace = get_trace(nb_off=3)+":"
+		print("[FATAL]", *args, file=sys.stderr, flush=True, **kwargs)
+	elif level == ERROR:
+		#trace = get_trace(nb_off=3)+":"
+		print("[ERROR]", *args, file=sys.stderr, flush=True, **kwargs)
+	elif level == WARNING:
+		#trace = get_trace()+":"
+		print("[WARNING]", *args, flush=True, **kwargs)
+	elif level == INFO:
+		print("[INFO]", *args, flush=True, **kwargs)
+	elif level == DEBUG:
+		print("[DEBUG]", *args, flush=True, **kwargs)
+	elif level == COMMAND:
+		print("[COMMAND]", *args, flush=True, **kwargs)
 
 def log_remote(level, log_level, out, err, *args, **kwargs):
 	if level <= log_level:
@@ -60,24 +102,57 @@ def log_remote(level, log_level, out, err, *args, **kwargs):
 		elif level == COMMAND:
 			print("[COMMAND]", *args, file=out, flush=True, **kwargs)
 
-def set_log_level(log_level):
-	global LOG_LEVEL
-
+# Return the level of a name (e.g. "DEBUG"), or None
+def parse_log_level(log_level):
 	if log_level=="FATAL":
-		LOG_LEVEL = FATAL
+		return FATAL
 	elif log_level=="ERROR":
-		LOG_LEVEL = ERROR
+		return ERROR
 	elif log_level=="WARNING":
-		LOG_LEVEL = WARNING
+		return WARNING
 	elif log_level=="INFO":
-		LOG_LEVEL = INFO
+		return INFO
 	elif log_level=="DEBUG":
-		LOG_LEVEL = DEBUG
+		return DEBUG
 	elif log_level=="CMD" or log_level=="COMMAND":
-		LOG_LEVEL = COMMAND
-	else:
+		return COMMAND
+	return None
+
+def set_log_level(log_level):
+	global LOG_LEVEL
+
+	level = parse_log_level(log_level)
+	if level is None:
 		print("common.utils.logs.set_log_level: invalid log level")
 		sys.exit(1)
+	LOG_LEVEL = level
+	COMPONENT_CACHE.clear()
+
+# Override the level of a component and its children (e.g. "sockets", "sockets.ClientSocket",
+# "shaper" or "shaper.<name>"): a level or its name, None to remove the override
+# Return False if the level is invalid
+def set_component_level(component, log_level):
+	if log_level is None:
+		COMPONENT_LEVELS.pop(component, None)
+	else:
+		level = parse_log_level(log_level) if isinstance(log_level, str) else log_level
+		if level not in LEVEL_NAMES: return False
+		COMPONENT_LEVELS[component] = level
+	COMPONENT_CACHE.clear()
+	return True
+
+# spec: comma separated overrides, e.g. "shaper=DEBUG,sockets.ClientSocket=WARNING"
+def set_component_levels(spec):
+	for item in spec.split(","):
+		if not item.strip(): continue
+		component, _, log_level = item.partition("=")
+		if not set_component_level(component.strip(), log_level.strip()):
+			log(ERROR, "common.utils.logs.set_component_levels: invalid log level for "+component.strip())
+			return False
+	return True
+
+def get_component_levels():
+	return { component: LEVEL_NAMES[level] for component, level in COMPONENT_LEVELS.items() }
 
 def get_log_level():
 	global LOG_LEVEL
@@ -0,0 +1,75 @@
+# External
+import bisect, os
+
+# Default buckets for durations, in seconds (from 10us to ~10s)
+LATENCY_BUCKETS = [ 0.00001 * 2**i for i in range(21) ]
+
+# Histogram with fixed buckets
+# A histogram is not thread-safe: it should only be updated by one thread (other
+# threads may read it, the result is then only approximately consistent)
+class Histogram:
+	def __init__(self, buckets=LATENCY_BUCKETS):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets)+1) # The last one counts the values above the last bucket
+		self.sum = 0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	# Approximate quantile (upper bound of the bucket containing it)
+	def quantile(self, q):
+		if self.count == 0: return None
+		rank = q * self.count
+		cumul = 0
+		for i, nb in enumerate(self.counts):
+			cumul += nb
+			if cumul >= rank:
+				return self.buckets[i] if i < len(self.buckets) else float("inf")
+		return float("inf")
+
+	def get(self):
+		return {
+			"count": self.count,
+			"sum": self.sum,
+			"buckets": list(zip(self.buckets+[float("inf")], self.counts)),
+			"p50": self.quantile(0.5),
+			"p90": self.quantile(0.9),
+			"p99": self.quantile(0.99)
+		}
+
+def format_labels(labels):
+	if not labels: return ""
+	return "{"+",".join([ k+"=\""+str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")+"\"" for k, v in labels.items() ])+"}"
+
+def format_value(value):
+	if value == float("inf"): return "+Inf"
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+# Render metrics in the Prometheus text format
+# metrics: list of (name, type, help, samples) where samples is a list of (labels, value)
+# and value is a number, or a Histogram for the "histogram" type
+def render_prometheus(metrics):
+	lines = []
+	for name, kind, doc, samples in metrics:
+		lines += [ "# HELP "+name+" "+doc, "# TYPE "+name+" "+kind ]
+		for labels, value in samples:
+			if kind == "histogram":
+				cumul = 0
+				for bound, nb in zip(value.buckets+[float("inf")], value.counts):
+					cumul += nb
+					lines += [ name+"_bucket"+format_labels({**labels, "le": format_value(bound)})+" "+str(cumul) ]
+				lines += [ name+"_sum"+format_labels(labels)+" "+format_value(value.sum) ]
+				lines += [ name+"_count"+format_labels(labels)+" "+str(value.count) ]
+			else:
+				lines += [ name+format_labels(labels)+" "+format_value(value) ]
+	return "\n".join(lines)+"\n"
+
+# Write a file atomically (readers never see a partially written file)
+def write_atomic(path, text):
+	tmp = path+".tmp"
+	with open(tmp, "w") as file:
+		file.write(text)
+	os.replace(tmp, path)
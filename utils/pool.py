@@ -0,0 +1,155 @@
+# External
+import random, select, socket, threading, time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Internal
+from common.utils.logs import *
+from common.utils.sockets import ClientSocket
+
+# Connection to one target of a ClientPool
+class PoolEntry:
+	def __init__(self, sock):
+		self.socket = sock
+		self.lock = threading.Lock() # One exchange at a time on the connection
+		self.failures = 0 # Consecutive failed connections
+		self.retry_at = 0 # No connection attempt before this time (backoff)
+		self.last_used = 0
+
+# Pool of ClientSockets, one per target (ip, port)
+# Connections are opened on demand with a timeout. After a failed connection, the target
+# is not tried again before a delay growing exponentially with the failures (from
+# backoff_min to backoff_max seconds, with jitter): exchanges with it fail immediately
+# in the meantime, so that dead targets do not stall the others.
+class ClientPool:
+	def __init__(self, connect_timeout=5, timeout=30, workers=32, backoff_min=0.5, backoff_max=60, negotiation=False, health_cmd=None):
+		self.name = None
+		self.connect_timeout = connect_timeout
+		self.timeout = timeout # Default timeout of the exchanges
+		self.backoff_min = backoff_min
+		self.backoff_max = backoff_max
+		self.negotiation = negotiation
+		self.health_cmd = health_cmd # Command sent by check (None to only check the connection)
+		self.entries = {} # (ip, port) -> PoolEntry
+		self.lock = threading.Lock()
+		self.executor = ThreadPoolExecutor(max_workers=workers)
+		self.health_thread = None
+		self.health_stop = threading.Event()
+
+	def get_name(self):
+		return self.__class__.__name__ if self.name is None else self.name
+
+	def set_name(self, name):
+		self.name = name
+
+	def get_entry(self, target):
+		with self.lock:
+			entry = self.entries.get(target)
+			if entry is None:
+				sock = ClientSocket(negotiation=self.negotiation)
+				sock.connect_timeout = self.connect_timeout
+				sock.ip, sock.port = target
+				entry = PoolEntry(sock)
+				self.entries[target] = entry
+			return entry
+
+	# Return whether the connection of the entry is open (the entry lock must be held)
+	def ensure_connected(self, target, entry):
+		if entry.socket.connected(): return True
+		now = time.monotonic()
+		if now < entry.retry_at:
+			logf(DEBUG, "%s.ensure_connected: %s is backing off", self.get_name(), target, component="pool")
+			return False
+		if entry.socket.connect():
+			entry.failures = 0
+			entry.retry_at = 0
+			return True
+		entry.failures += 1
+		delay = min(self.backoff_max, self.backoff_min * 2**(entry.failures-1))
+		entry.retry_at = now + delay * random.uniform(0.5, 1)
+		log(WARNING, self.get_name()+".ensure_connected: failed to connect to "+str(target)+" ("+str(entry.failures)+" failures)")
+		return False
+
+	# Same as ClientSocket.exchange, on the connection to target
+	# Return the answer, or None if the target cannot be reached
+	def exchange(self, target, commands=[], data=None, timeout=None, retry=1):
+		entry = self.get_entry(target)
+		with entry.lock:
+			if not self.ensure_connected(target, entry): return None
+			entry.last_used = time.monotonic()
+			res = entry.socket.exchange(commands, data, timeout=self.timeout if timeout is None else timeout, retry=retry)
+			if res is None and not entry.socket.connected():
+				# The reconnection failed: back off
+				entry.failures += 1
+				entry.retry_at = time.monotonic() + self.backoff_min * random.uniform(0.5, 1)
+			return res
+
+	# Run the same exchange with every target in parallel
+	# Return a dictionary target -> answer (None for the targets that failed or did not
+	# answer before timeout)
+	def fan_out(self, commands=[], data=None, targets=None, timeout=None, retry=1):
+		targets = list(self.entries) if targets is None else list(targets)
+		timeout = self.timeout if timeout is None else timeout
+		futures = { target: self.executor.submit(self.exchange, target, commands, data, timeout, retry) for target in targets }
+		wait(futures.values(), timeout=self.connect_timeout+timeout*(retry+1))
+		res = {}
+		for target, future in futures.items():
+			res[target] = future.result() if future.done() and future.exception() is None else None
+		return res
+
+	# Check the connection to target (with health_cmd if set)
+	# Return whether the target is healthy
+	def check(self, target):
+		entry = self.get_entry(target)
+		if self.health_cmd is not None:
+			return self.exchange(target, [self.health_cmd], retry=0) is not None
+		with entry.lock:
+			if entry.socket.connected() and not peer_alive(entry.socket.socket):
+				entry.socket.close()
+			return self.ensure_connected(target, entry)
+
+	# Check every target in parallel
+	# Return a dictionary target -> healthy
+	def check_all(self):
+		futures = { target: self.executor.submit(self.check, target) for target in list(self.entries) }
+		return { target: future.result() for target, future in futures.items() }
+
+	# Check the targets idle for more than interval seconds, every interval seconds
+	def start_health_checks(self, interval=60):
+		def routine():
+			while not self.health_stop.wait(interval):
+				idle = [ target for target, entry in list(self.entries.items()) if time.monotonic()-entry.last_used >= interval ]
+				for target in idle:
+					self.executor.submit(self.check, target)
+		self.health_stop.clear()
+		self.health_thread = threading.Thread(target=routine, name=self.get_name()+"-health", daemon=True)
+		self.health_thread.start()
+
+	def get_stats(self):
+		return {
+			str(target): {
+				"connected": entry.socket.connected(),
+				"failures": entry.failures,
+				"backoff": max(0, entry.retry_at-time.monotonic())
+			} for target, entry in list(self.entries.items())
+		}
+
+	def remove(self, target):
+		with self.lock:
+			entry = self.entries.pop(target, None)
+		if entry is not None:
+			with entry.lock:
+				entry.socket.close()
+
+	def close(self):
+		self.health_stop.set()
+		for target in list(self.entries):
+			self.remove(target)
+		self.executor.shutdown(wait=False)
+
+# Whether the peer of a connected socket has not closed the connection (without blocking)
+def peer_alive(sock):
+	try:
+		readable, _, _ = select.select([sock], [], [], 0)
+		return not readable or sock.recv(1, socket.MSG_PEEK) != b""
+	except OSError:
+		return False
@@ -0,0 +1,313 @@
+# External
+import io, pickle, struct, time, zlib
+
+# Serialization codecs used by ProtoSocket frames
+# Each codec has a one-byte identifier written in the frame header, so the receiver knows
+# how to decode a frame. The codecs available on a connection are negotiated (see
+# ProtoSocket.negotiate); "pickle" is always available.
+#
+# A codec provides:
+#	- encode(obj): list of buffers (sent with a single vectored write)
+#	- decode(view): object decoded from a memoryview on the frame payload
+#	- can_encode(obj): whether the codec can encode the object
+#	- owns_buffer: whether decoded objects may keep references to the payload buffer
+#	  (the payload is then received in a buffer that is not reused)
+
+CODEC_MASK = 0x0f # Codec identifier in the frame tag (the other bits are flags)
+FLAG_COMPRESSED = 0x10 # The payload is compressed with the compressor negotiated for the connection
+FLAG_STREAM = 0x20 # The payload is a raw chunk of a stream (an empty chunk ends the stream)
+FLAG_REQUEST_ID = 0x40 # The payload starts with a request identifier (multiplexed connections)
+FLAG_SHM = 0x80 # The payload is in a shared memory file passed with the frame (local connections)
+OOB_THRESHOLD = 4096 # bytes and bytearray objects sent out-of-band by the pickle5 codec
+
+# Default pickle protocol
+class PickleCodec:
+	id = 0
+	name = "pickle"
+	owns_buffer = False
+
+	def can_encode(self, obj):
+		return True
+
+	def encode(self, obj):
+		return [ pickle.dumps(obj) ]
+
+	def decode(self, view):
+		return pickle.loads(view)
+
+FOREIGN_BUFFERS = 0x80000000 # Pickle5Codec: some buffers are not copied when decoded
+
+# Big bytes or bytearray object sent out-of-band: pickled as a PickleBuffer on the object,
+# and decoded as a copy of the received buffer
+# (the pickler never calls reducer_override for bytes and bytearray objects, so they are
+# wrapped before being pickled)
+class OutOfBandBuffer:
+	def __init__(self, obj, wrapped):
+		self.obj = obj
+		self.wrapped = wrapped # Out-of-band buffers created by the wrappers of the object
+
+	def __reduce_ex__(self, protocol):
+		self.wrapped.append(self)
+		return type(self.obj), (pickle.PickleBuffer(self.obj),)
+
+# Return obj with its big bytes and bytearray objects wrapped (in dict, list and tuple
+# containers, which are copied only if they hold such objects)
+def wrap_buffers(obj, wrapped, memo):
+	kind = type(obj)
+	if kind is bytes or kind is bytearray:
+		if len(obj) < OOB_THRESHOLD: return obj
+		if id(obj) not in memo: memo[id(obj)] = OutOfBandBuffer(obj, wrapped) # Sent once
+		return memo[id(obj)]
+	if kind is not dict and kind is not list and kind is not tuple:
+		return obj
+	if id(obj) in memo: return memo[id(obj)]
+	memo[id(obj)] = obj # Cycles are left as they are
+	if kind is dict:
+		items = { key: wrap_buffers(value, wrapped, memo) for key, value in obj.items() }
+		changed = any([ items[key] is not value for key, value in obj.items() ])
+	else:
+		items = [ wrap_buffers(value, wrapped, memo) for value in obj ]
+		changed = any([ new is not old for new, old in zip(items, obj) ])
+		if kind is tuple: items = tuple(items)
+	res = items if changed else obj
+	memo[id(obj)] = res
+	return res
+
+# Pickle protocol 5 with out-of-band buffers: the big buffers (bytes, bytearray,
+# PickleBuffer, numpy arrays, ...) are sent as they are, after the pickle, without being
+# copied into it
+# The bytes and bytearray objects are copied from the payload when decoded, so the payload
+# buffer can be reused. The other buffers (PickleBuffer, numpy arrays) may be decoded as
+# views on their buffer: the frame then has the FOREIGN_BUFFERS flag, and they are copied
+# before being decoded.
+# Payload: number of buffers (and flag), pickle size, size of each buffer, pickle, buffers
+class Pickle5Codec:
+	id = 1
+	name = "pickle5"
+	owns_buffer = False
+
+	def can_encode(self, obj):
+		return True
+
+	def encode(self, obj):
+		buffers = []
+		wrapped = []
+		out = io.BytesIO()
+		pickle.Pickler(out, protocol=5, buffer_callback=buffers.append).dump(wrap_buffers(obj, wrapped, {}))
+		serial = out.getbuffer()
+		raws = [ buf.raw() for buf in buffers ]
+		sizes = [ len(serial) ] + [ raw.nbytes for raw in raws ]
+		flags = FOREIGN_BUFFERS if len(buffers) > len(wrapped) else 0
+		return [ struct.pack("<I"+str(len(sizes))+"Q", len(raws) | flags, *sizes), serial ] + raws
+
+	def decode(self, view):
+		nb = struct.unpack_from("<I", view, 0)[0]
+		foreign = nb & FOREIGN_BUFFERS
+		nb &= ~FOREIGN_BUFFERS
+		sizes = struct.unpack_from("<"+str(nb+1)+"Q", view, 4)
+		off = 4+8*(nb+1)
+		parts = []
+		for size in sizes:
+			parts += [ view[off:off+size] ]
+			off += size
+		buffers = [ bytearray(part) for part in parts[1:] ] if foreign else parts[1:]
+		return pickle.loads(parts[0], buffers=buffers)
+
+# msgpack (only when the msgpack module is installed)
+# Only encodes the objects made of basic types that are decoded as they are: None, bool,
+# int, float, str, bytes, lists and dicts (tuples would be decoded as lists)
+class MsgpackCodec:
+	id = 2
+	name = "msgpack"
+	owns_buffer = False
+	max_depth = 512 # Nesting limit of msgpack
+
+	def __init__(self):
+		import msgpack
+		self.msgpack = msgpack
+
+	def can_encode(self, obj, depth=0):
+		kind = type(obj)
+		if obj is None or kind is bool or kind is float or kind is str or kind is bytes:
+			return True
+		if kind is int:
+			return -2**63 <= obj < 2**64
+		if depth >= self.max_depth:
+			return False
+		if kind is list:
+			return all([ self.can_encode(item, depth+1) for item in obj ])
+		if kind is dict:
+			return all([ self.can_encode(key, depth+1) and self.can_encode(value, depth+1) for key, value in obj.items() ])
+		return False
+
+	def encode(self, obj):
+		return [ self.msgpack.packb(obj, use_bin_type=True) ]
+
+	def decode(self, view):
+		return self.msgpack.unpackb(view, raw=False, strict_map_key=False)
+
+# Fixed layout for the small answers: {"success": bool} or {"success": bool, "answer": value}
+# where value is None, a bool, a 64-bit integer or a short string
+# Payload: success (1 byte), kind of answer (1 byte), integer value (8 bytes), string
+class AnswerCodec:
+	id = 3
+	name = "answer"
+	owns_buffer = False
+	layout = struct.Struct("<?Bq")
+	NO_ANSWER, NONE, BOOL, INT, STR = range(5)
+
+	def can_encode(self, obj):
+		if type(obj) is not dict or type(obj.get("success")) is not bool:
+			return False
+		if len(obj) == 1:
+			return True
+		if len(obj) != 2 or "answer" not in obj:
+			return False
+		answer = obj["answer"]
+		if answer is None or type(answer) is bool:
+			return True
+		if type(answer) is int:
+			return -2**63 <= answer < 2**63
+		return type(answer) is str and len(answer) <= 256
+
+	def encode(self, obj):
+		answer = obj.get("answer")
+		if "answer" not in obj:
+			return [ self.layout.pack(obj["success"], self.NO_ANSWER, 0) ]
+		elif answer is None:
+			return [ self.layout.pack(obj["success"], self.NONE, 0) ]
+		elif type(answer) is bool:
+			return [ self.layout.pack(obj["success"], self.BOOL, answer) ]
+		elif type(answer) is int:
+			return [ self.layout.pack(obj["success"], self.INT, answer) ]
+		else:
+			return [ self.layout.pack(obj["success"], self.STR, 0), answer.encode() ]
+
+	def decode(self, view):
+		success, kind, value = self.layout.unpack_from(view, 0)
+		res = {"success": success}
+		if kind == self.NONE:
+			res["answer"] = None
+		elif kind == self.BOOL:
+			res["answer"] = bool(value)
+		elif kind == self.INT:
+			res["answer"] = value
+		elif kind == self.STR:
+			res["answer"] = bytes(view[self.layout.size:]).decode()
+		return res
+
+CODECS = {} # Name -> codec
+CODECS_BY_ID = {} # Identifier -> codec
+
+def register_codec(codec):
+	CODECS[codec.name] = codec
+	CODECS_BY_ID[codec.id] = codec
+
+register_codec(PickleCodec())
+register_codec(Pickle5Codec())
+try:
+	register_codec(MsgpackCodec())
+except ModuleNotFoundError:
+	pass
+register_codec(AnswerCodec())
+
+# Names of the codecs available locally, by order of preference
+def available_codecs():
+	return [ name for name in ["answer", "pickle5", "msgpack", "pickle"] if name in CODECS ] + \
+		[ name for name in CODECS if name not in ["answer", "pickle5", "msgpack", "pickle"] ]
+
+# Compressors (the one used on a connection is negotiated)
+# A compressor provides compress(buffers) -> bytes and decompress(view) -> bytes
+class ZlibCompressor:
+	name = "zlib"
+
+	def __init__(self, level=1):
+		self.level = level
+
+	def compress(self, buffers):
+		compressor = zlib.compressobj(self.level)
+		return b"".join([ compressor.compress(buf) for buf in buffers ]+[ compressor.flush() ])
+
+	def decompress(self, view):
+		return zlib.decompress(view)
+
+# zstd (only when the zstandard module is installed)
+class ZstdCompressor:
+	name = "zstd"
+
+	def __init__(self, level=3):
+		import zstandard
+		self.compressor = zstandard.ZstdCompressor(level=level)
+		self.decompressor = zstandard.ZstdDecompressor()
+
+	def compress(self, buffers):
+		compressor = self.compressor.compressobj()
+		return b"".join([ compressor.compress(buf) for buf in buffers ]+[ compressor.flush() ])
+
+	def decompress(self, view):
+		return self.decompressor.decompressobj().decompress(view)
+
+# lz4 (only when the lz4 module is installed)
+class Lz4Compressor:
+	name = "lz4"
+
+	def __init__(self):
+		import lz4.frame
+		self.lz4 = lz4.frame
+
+	def compress(self, buffers):
+		return self.lz4.compress(b"".join(buffers) if len(buffers) > 1 else buffers[0])
+
+	def decompress(self, view):
+		return self.lz4.decompress(view)
+
+COMPRESSORS = {} # Name -> compressor
+
+def register_compressor(compressor):
+	COMPRESSORS[compressor.name] = compressor
+
+register_compressor(ZlibCompressor())
+try:
+	register_compressor(ZstdCompressor())
+except ModuleNotFoundError:
+	pass
+try:
+	register_compressor(Lz4Compressor())
+except ModuleNotFoundError:
+	pass
+
+# Names of the compressors available locally, by order of preference
+def available_compressors():
+	return [ name for name in ["zstd", "lz4", "zlib"] if name in COMPRESSORS ] + \
+		[ name for name in COMPRESSORS if name not in ["zstd", "lz4", "zlib"] ]
+
+# Measure the encoding and decoding time of each codec for several message sizes
+# Return a list of (codec name, message size, encoded size, encode time, decode time)
+# with the times in microseconds per message
+def bench_codecs(sizes=[16, 1024, 65536, 1048576], nb=200):
+	res = []
+	messages = [ ("answer", {"success": True, "answer": 42}) ]
+	messages += [ (size, {"success": True, "answer": bytearray(size)}) for size in sizes ]
+	for size, msg in messages:
+		for name, codec in CODECS.items():
+			if not codec.can_encode(msg): continue
+			try:
+				buffers = codec.encode(msg)
+			except TypeError:
+				continue
+			start = time.perf_counter()
+			for _ in range(nb):
+				buffers = codec.encode(msg)
+			encode = (time.perf_counter()-start)/nb*1000000
+			payload = memoryview(b"".join([ bytes(buf) for buf in buffers ]))
+			start = time.perf_counter()
+			for _ in range(nb):
+				codec.decode(payload)
+			decode = (time.perf_counter()-start)/nb*1000000
+			res += [ (name, size, len(payload), encode, decode) ]
+	return res
+
+if __name__ == "__main__":
+	print("codec".ljust(11)+"message".ljust(11)+"encoded".ljust(12)+"encode(us)".ljust(12)+"decode(us)")
+	for name, size, encoded, encode, decode in bench_codecs():
+		print(name.ljust(11)+str(size).ljust(11)+str(encoded).ljust(12)+("%.2f" % encode).ljust(12)+("%.2f" % decode))
@@ -1,22 +1,442 @@
 # External
-import threading
+import heapq
+import itertools
+import os
+import random
+import selectors
 import socket
-import select
+import struct
+import sys
+import threading
 from collections import deque
 import time
 
 # Internal
 from common.utils.logs import *
+from common.utils.capture import CAPTURE_IN, CAPTURE_OUT
+from common.utils.metrics import *
 
 SEND_BUF_SIZE = 65535
 RECV_BUF_SIZE = 65535
+BATCH_SIZE = 64 # Maximum number of packets received / sent by a Shaper per loop iteration
+MAX_PEER_BUCKETS = 4096 # Maximum number of per-address token buckets kept by a Shaper
+
+# Linux UDP segmentation offload (see udp(7)), not exported by the socket module
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+UDP_GRO = getattr(socket, "UDP_GRO", 104)
+GSO_MAX_SEGMENTS = 64 # Maximum number of segments per GSO send
+GSO_MAX_SIZE = 65000 # Maximum number of bytes per GSO send
+GRO_CMSG_SIZE = socket.CMSG_SPACE(4)
+
+# Policies applied when a sending queue is full
+DROP_TAIL = "drop-tail" # Drop the new packet
+DROP_HEAD = "drop-head" # Drop the oldest packet
+BLOCK = "block" # Stop reading on the peer (the producer) until the queue is half empty
+
+# Memory used by the sending queues of all the Shapers of the process
+# The limit should be set (see set_memory_budget) before the Shapers are started
+class MemoryBudget:
+	def __init__(self, limit=None):
+		self.limit = limit
+		self.used = 0
+		self.lock = threading.Lock()
+
+	def acquire(self, size):
+		if self.limit is None: return True
+		with self.lock:
+			if self.used+size > self.limit: return False
+			self.used += size
+			return True
+
+	# Take size bytes even if it exceeds the limit
+	def charge(self, size):
+		if self.limit is None: return
+		with self.lock:
+			self.used += size
+
+	def release(self, size):
+		if self.limit is None: return
+		with self.lock:
+			self.used -= size
+
+memory_budget = MemoryBudget()
+
+def set_memory_budget(limit):
+	memory_budget.limit = limit
+
+# Token bucket: rate in bytes per second, burst in bytes
+# A packet bigger than the burst is accepted when the bucket is full (the bucket
+# then goes below zero) so that it is delayed instead of blocked forever
+class TokenBucket:
+	def __init__(self, rate, burst=None):
+		self.rate = rate
+		self.burst = rate if burst is None else burst
+		self.tokens = self.burst
+		self.stamp = time.monotonic()
+
+	def refill(self, now):
+		self.tokens = min(self.burst, self.tokens+(now-self.stamp)*self.rate)
+		self.stamp = now
+
+	# Take size tokens if available
+	def consume(self, size, now):
+		self.refill(now)
+		if self.tokens >= min(size, self.burst):
+			self.tokens -= size
+			return True
+		return False
+
+	# Time to wait before size tokens are available
+	def delay(self, size, now):
+		self.refill(now)
+		return max(0, min(size, self.burst)-self.tokens)/self.rate
+
+# Timer scheduled on a ShaperEngine (see ShaperEngine.call_later)
+class EngineTimer:
+	def __init__(self, when, func, args):
+		self.when = when
+		self.func = func
+		self.args = args
+		self.cancelled = False
+
+	def cancel(self):
+		self.cancelled = True
+
+# Event loop serving many Shaper flows from a single thread
+# Every Shaper socket is registered once for reading, and the write interest is
+# only modified when the Shaper's sending queue becomes empty / non-empty.
+# Other threads never touch the selector: they schedule callbacks (call_soon)
+# that the loop thread runs after being woken up. Wakeups are coalesced: the wake
+# channel is only written when no wakeup is already pending.
+class ShaperEngine:
+	def __init__(self, name="ShaperEngine", timeout=60, daemon=True):
+		self.name = name
+		self.log_component = "shaper."+name
+		self.timeout = timeout
+		self.daemon = daemon
+		self.thread = None
+		self.lock = threading.Lock()
+		self.selector = selectors.DefaultSelector()
+		self.shapers = set()
+
+		# Metrics (updated by the loop thread only)
+		self.iterations = Histogram() # Time spent handling events, callbacks and timers per iteration
+		self.metrics_timer = None
+
+		# Receive buffer shared by the Shapers of this engine (they all run in the loop thread)
+		self.recv_buffer = bytearray(RECV_BUF_SIZE)
+		self.recv_view = memoryview(self.recv_buffer)
+
+		# Callbacks scheduled by other threads
+		self.callbacks = deque()
+
+		# Timers heap: (deadline, sequence, EngineTimer)
+		self.timers = []
+		self.timers_seq = itertools.count()
+
+		# Additional fd to unblock the select operation before the timeout
+		# (an eventfd when available, a pipe otherwise)
+		self.wake_pending = False
+		if hasattr(os, "eventfd"):
+			self.wake_rfd = self.wake_wfd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+			self.wake_msg = (1).to_bytes(8, sys.byteorder)
+		else:
+			self.wake_rfd, self.wake_wfd = os.pipe()
+			os.set_blocking(self.wake_rfd, False)
+			os.set_blocking(self.wake_wfd, False)
+			self.wake_msg = b"1"
+		self.selector.register(self.wake_rfd, selectors.EVENT_READ, None)
+
+	def __del__(self):
+		if self.wake_rfd is not None:
+			os.close(self.wake_rfd)
+		if self.wake_wfd is not None and self.wake_wfd != self.wake_rfd:
+			os.close(self.wake_wfd)
+
+	def log(self, lev, *args, **kwargs):
+		if is_enabled(lev, self.log_component):
+			print_log(lev, "["+self.name+"]", *args, **kwargs)
+
+	def start(self):
+		with self.lock:
+			if self.thread is not None: return
+			self.thread = threading.Thread(target=self.run, name=self.name, daemon=self.daemon)
+			self.thread.start()
+
+	# Run the loop in the calling thread until stop is called
+	def run_forever(self):
+		with self.lock:
+			if self.thread is not None: return
+			self.thread = threading.current_thread()
+		self.run()
+
+	def stop(self):
+		with self.lock:
+			thread = self.thread
+			self.thread = None
+		self.wake()
+		if thread is not None and thread is not threading.current_thread():
+			thread.join()
+
+	def running(self):
+		return self.thread is not None
+
+	# Whether the caller runs in the loop thread
+	def in_loop(self):
+		return self.thread is threading.current_thread()
+
+	def wake(self):
+		if self.wake_pending: return
+		self.wake_pending = True
+		try:
+			os.write(self.wake_wfd, self.wake_msg)
+		except BlockingIOError:
+			pass # The wake channel is full, the loop will wake up anyway
+
+	# Run func(*args) in the loop thread (thread-safe)
+	def call_soon(self, func, *args):
+		self.callbacks.append((func, args))
+		if not self.in_loop():
+			self.wake()
+
+	# Run func(*args) in the loop thread after delay seconds (thread-safe)
+	# Return an EngineTimer that can be cancelled
+	def call_later(self, delay, func, *args):
+		timer = EngineTimer(time.monotonic()+delay, func, args)
+		if self.in_loop():
+			self.schedule(timer)
+		else:
+			self.call_soon(self.schedule, timer)
+		return timer
+
+	def schedule(self, timer):
+		heapq.heappush(self.timers, (timer.when, next(self.timers_seq), timer))
+
+	# Run func(*args) in the loop thread and wait for its result
+	def call_sync(self, func, *args):
+		if self.in_loop() or not self.running():
+			return func(*args)
+		done = threading.Event()
+		res = []
+		def wrapper():
+			try:
+				res.append(func(*args))
+			finally:
+				done.set()
+		self.call_soon(wrapper)
+		done.wait()
+		return res[0] if res else None
+
+	# Register a Shaper (its socket must be opened)
+	def add(self, shaper):
+		self.start()
+		self.call_sync(self.register, shaper)
+
+	# Unregister a Shaper
+	def remove(self, shaper):
+		self.call_sync(self.unregister, shaper)
+
+	def register(self, shaper):
+		if shaper in self.shapers: return
+		self.shapers.add(shaper)
+		shaper.writing = shaper.can_write()
+		self.update_events(shaper)
+
+	def unregister(self, shaper):
+		if shaper not in self.shapers: return
+		self.shapers.discard(shaper)
+		if shaper.events:
+			self.selector.unregister(shaper.sock)
+			shaper.events = 0
+
+	# Apply the read / write interests of a Shaper to the selector
+	# (a Shaper that neither reads nor writes is removed from the selector)
+	def update_events(self, shaper):
+		events = 0
+		if shaper.reading: events |= selectors.EVENT_READ
+		if shaper.writing: events |= selectors.EVENT_WRITE
+		if events == shaper.events: return
+		if not events:
+			self.selector.unregister(shaper.sock)
+		elif not shaper.events:
+			self.selector.register(shaper.sock, events, shaper)
+		else:
+			self.selector.modify(shaper.sock, events, shaper)
+		shaper.events = events
+
+	# Enable or disable the write interest of a Shaper (loop thread only)
+	def set_writing(self, shaper, writing):
+		if shaper.writing == writing or shaper not in self.shapers: return
+		shaper.writing = writing
+		self.update_events(shaper)
+
+	# Enable or disable the read interest of a Shaper (loop thread only)
+	def set_reading(self, shaper, reading):
+		if shaper.reading == reading or shaper not in self.shapers: return
+		shaper.reading = reading
+		self.update_events(shaper)
+
+	def run(self):
+		me = threading.current_thread()
+		while self.thread is me:
+			self.run_callbacks()
+			events = self.selector.select(self.next_timeout())
+			start = time.monotonic()
+			for key, mask in events:
+				if key.data is None:
+					self.log(DEBUG, "run: got awaken")
+					self.drain_wake()
+				else:
+					self.dispatch(key.data, key.fileobj, mask)
+			self.run_timers()
+			self.iterations.observe(time.monotonic()-start)
+
+	def dispatch(self, shaper, s, mask):
+		try:
+			if mask & selectors.EVENT_READ and shaper in self.shapers:
+				shaper.handle_read(s)
+			if mask & selectors.EVENT_WRITE and shaper in self.shapers:
+				shaper.handle_write(s)
+		except Exception as err:
+			shaper.log(ERROR, "dispatch: an error occured:", err)
+
+	# Reset the pending flag after draining: a wakeup written before it is consumed by the
+	# read, but its callback is run by run_callbacks (which always follows the drain)
+	def drain_wake(self):
+		try:
+			while os.read(self.wake_rfd, 4096):
+				pass
+		except BlockingIOError:
+			pass
+		self.wake_pending = False
+
+	def run_callbacks(self):
+		for _ in range(len(self.callbacks)):
+			func, args = self.callbacks.popleft()
+			try:
+				func(*args)
+			except Exception as err:
+				self.log(ERROR, "run_callbacks: an error occured:", err)
+
+	def next_timeout(self):
+		if self.callbacks:
+			return 0
+		if self.timers:
+			return max(0, min(self.timers[0][0]-time.monotonic(), self.timeout))
+		return self.timeout
+
+	def run_timers(self):
+		now = time.monotonic()
+		while self.timers and self.timers[0][0] <= now:
+			_, _, timer = heapq.heappop(self.timers)
+			if timer.cancelled: continue
+			try:
+				timer.func(*timer.args)
+			except Exception as err:
+				self.log(ERROR, "run_timers: an error occured:", err)
+
+	def get_stats(self):
+		return {
+			"name": self.name,
+			"shapers": len(self.shapers),
+			"iterations": self.iterations.get()
+		}
+
+	# Metrics of the engine and its Shapers in the Prometheus text format
+	def metrics(self):
+		labels = {"engine": self.name}
+		return render_prometheus([
+			("honeywalt_engine_shapers", "gauge", "Number of Shapers served by the engine", [(labels, len(self.shapers))]),
+			("honeywalt_engine_iteration_seconds", "histogram", "Time spent per event loop iteration", [(labels, self.iterations)])
+		] + shapers_metrics(list(self.shapers)))
+
+	# Periodically write the metrics to a file (e.g. for the node_exporter textfile collector)
+	def export_metrics(self, path, interval=15):
+		def export():
+			try:
+				write_atomic(path, self.metrics())
+			except OSError as err:
+				self.log(ERROR, "export_metrics: failed to write metrics:", err)
+			self.metrics_timer = self.call_later(interval, export)
+		if self.metrics_timer is not None: self.metrics_timer.cancel()
+		self.metrics_timer = self.call_later(0, export)
+
+# Metrics of several Shapers in the format expected by render_prometheus
+def shapers_metrics(shapers):
+	counters = [
+		("honeywalt_shaper_sent_packets_total", "counter", "Packets sent", lambda shaper: shaper.sent_packets),
+		("honeywalt_shaper_sent_bytes_total", "counter", "Bytes sent", lambda shaper: shaper.total_sent),
+		("honeywalt_shaper_received_packets_total", "counter", "Packets received", lambda shaper: shaper.recv_packets),
+		("honeywalt_shaper_received_bytes_total", "counter", "Bytes received", lambda shaper: shaper.total_recv),
+		("honeywalt_shaper_dropped_packets_total", "counter", "Packets dropped", lambda shaper: shaper.total_dropped),
+		("honeywalt_shaper_blocked_total", "counter", "Times the peer was asked to stop reading", lambda shaper: shaper.total_blocked),
+		("honeywalt_shaper_queue_packets", "gauge", "Packets in the sending queue", lambda shaper: shaper.queue_length()),
+		("honeywalt_shaper_queue_bytes", "gauge", "Bytes in the sending queue", lambda shaper: shaper.queued_bytes),
+		("honeywalt_shaper_queue_packets_max", "gauge", "High-water mark of the packets in the sending queue", lambda shaper: shaper.max_queued_packets),
+		("honeywalt_shaper_queue_bytes_max", "gauge", "High-water mark of the bytes in the sending queue", lambda shaper: shaper.max_queued_bytes)
+	]
+	metrics = []
+	for name, kind, doc, get in counters:
+		metrics += [ (name, kind, doc, [ ({"shaper": shaper.name}, get(shaper)) for shaper in shapers ]) ]
+	metrics += [ ("honeywalt_shaper_drops_total", "counter", "Packets dropped, by reason",
+		[ ({"shaper": shaper.name, "reason": reason}, getattr(shaper, "drops_"+reason)) for shaper in shapers for reason in ["policed", "queue", "budget"] ]) ]
+	metrics += [ ("honeywalt_shaper_forward_latency_seconds", "histogram", "Time between the forwarding and the sending of a packet",
+		[ ({"shaper": shaper.name}, shaper.latencies) for shaper in shapers ]) ]
+	return metrics
+
+# Engine shared by the Shapers that are not given an engine explicitly
+default_engine = None
+default_engine_lock = threading.Lock()
+
+def get_engine():
+	global default_engine
+	with default_engine_lock:
+		if default_engine is None:
+			default_engine = ShaperEngine(name="ShaperEngine-default")
+		return default_engine
+
+# The loop thread does not survive a fork: a child process gets its own default engine
+def reset_default_engine():
+	global default_engine, default_engine_lock
+	default_engine = None
+	default_engine_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=reset_default_engine)
 
 class Shaper:
-	def __init__(self, name="Shaper", timeout=60, status_timeout=21600):
+	def __init__(self, name="Shaper", timeout=60, status_timeout=21600, engine=None, batch_size=BATCH_SIZE,
+		rate=None, burst=None, peer_rate=None, peer_burst=None, latency=0, jitter=0,
+		max_packets=None, max_bytes=None, policy=DROP_TAIL, budget=None, reuse_port=False, offload=False,
+		capture=None):
 		self.keep_running = False
-		self.thread = None
-		self.lock = None
 		self.name = name
+		self.log_component = "shaper."+name # Level overrides: "shaper" or "shaper.<name>"
+
+		# Maximum number of packets handled per read / write event (fairness between Shapers)
+		self.batch_size = batch_size
+
+		# Shaping (rates in bytes per second, bursts in bytes, latency and jitter in seconds)
+		#	- rate/burst: pacing of the packets sent by this Shaper
+		#	- peer_rate/peer_burst: policing of the packets received from each UDP address
+		#	- latency/jitter: delay added to each packet before it is sent (order is kept)
+		self.bucket = None if rate is None else TokenBucket(rate, burst)
+		self.paced = False
+		self.pacing_timer = None
+		self.peer_rate = peer_rate
+		self.peer_burst = peer_burst
+		self.peer_buckets = {}
+		self.latency = latency
+		self.jitter = jitter
+		self.delayed = deque() # (release time, forward time, packet)
+		self.last_release = 0
+		self.delay_timer = None
+
+		# Event loop serving this Shaper (the default engine is shared by all Shapers)
+		self.engine = engine
+		self.own_engine = False
+		self.reading = True
+		self.writing = False
+		self.events = 0 # Events registered in the engine's selector
 
 		# Status
 		self.status_timer = None
@@ -24,11 +444,22 @@ class Shaper:
 
 		# Socket
 		self.sock = None
-		self.timeout = timeout
+		self.reuse_port = reuse_port # Several processes may bind the same address (see ShaperShards)
+
+		# UDP GSO/GRO: receive coalesced datagrams, and send same-size packets in a single
+		# sendmsg. Each of them is disabled if the kernel rejects it.
+		self.offload = offload
+		self.gro = False
+		self.gso = False
+
+		# Capture ring (see common.utils.capture.CaptureRing) recording the packets received and sent
+		self.capture = capture
+		self.timeout = timeout # Only used when the Shaper runs its own engine (see run)
 
 		# Peer's UDP host and port
 		self.udp_host = None
 		self.udp_port = None
+		self.on_address = None # Called with (shaper, host, port) when a new UDP peer is learned (engine thread)
 
 		# Local UDP host and port
 		self.udp_listen_host = None
@@ -37,155 +468,472 @@ class Shaper:
 		# Peer
 		self.peer = None
 
-		# Messages to forward
+		# Messages to forward, with the time they were forwarded at (only accessed by the engine thread)
+		# The queue (including the delayed packets) is bounded by max_packets and max_bytes,
+		# and by the memory budget shared with the other Shapers
 		self.sending_queue = deque()
-
-		# Selection lists
-		self.rsocks = set()
-		self.wsocks = set()
-
-		# Additional socket to unblock the select operation before the timeout
-		self.wake_addr = ("127.0.0.1", 0) # Port will be chosen randomly
-		self.wake_sock_listen = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-		self.wake_sock_listen.bind(self.wake_addr)
-		self.wake_sock_listen.setblocking(0)
-		self.wake_addr = ("127.0.0.1", self.wake_sock_listen.getsockname()[1]) # Getting port number
-		self.wake_sock_client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-		self.wake_sock_client.setblocking(0)
-		self.wake_msg = b"1"
-
-		# Counters
+		self.max_packets = max_packets
+		self.max_bytes = max_bytes
+		self.policy = policy
+		self.budget = memory_budget if budget is None else budget
+		self.queued_bytes = 0
+		self.blocking = False # Whether the peer was asked to stop reading
+
+		# Messages forwarded by a peer running on another thread
+		# Single producer (the peer) / single consumer (the engine): deque.append and
+		# deque.popleft are atomic so no lock is needed. The engine is only signaled
+		# when the inbox goes from empty to non-empty.
+		self.inbox = deque()
+		self.inbox_signaled = False
+
+		# Counters (only updated by the engine thread)
 		self.total_sent = 0
 		self.total_recv = 0
+		self.sent_packets = 0
+		self.recv_packets = 0
+		self.max_queued_packets = 0
+		self.max_queued_bytes = 0
+		self.latencies = Histogram() # Time between forward and sendto
+		self.total_dropped = 0
+		self.drops_policed = 0 # Above the peer_rate
+		self.drops_queue = 0 # Above max_packets or max_bytes
+		self.drops_budget = 0 # Above the memory budget
+		self.total_blocked = 0 # Number of times the peer was asked to stop reading
 
 	def __del__(self):
 		if self.sock is not None:
 			self.sock.close()
-		if self.wake_sock_listen is not None:
-			self.wake_sock_listen.close()
-		if self.wake_sock_client is not None:
-			self.wake_sock_client.close()
 
 	def start(self, show_status=True):
-		self.lock = threading.Lock()
-
-		self.thread = threading.Thread(target=self.run)
-		self.thread.start()
+		if self.engine is None:
+			self.engine = get_engine()
+		self.open()
+		self.engine.add(self)
+		if self.inbox: self.signal_inbox() # Forwarded before the start
 
 		if show_status:
 			self.start_status_timer()
 
+	# The packets still queued are dropped
 	def stop(self):
 		self.keep_running = False
-		self.wake()
-		if self.thread is not None: self.thread.join()
 		if self.status_timer is not None: self.status_timer.cancel()
+		if self.pacing_timer is not None: self.pacing_timer.cancel()
+		self.paced = False
+		self.pacing_timer = None
+		if self.delay_timer is not None: self.delay_timer.cancel()
+		self.delay_timer = None
+		if self.engine is not None:
+			self.engine.remove(self)
+			if self.own_engine: self.engine.stop()
+		self.total_dropped += self.queue_length()
+		self.sending_queue.clear()
+		self.delayed.clear()
+		self.budget.release(self.queued_bytes)
+		self.queued_bytes = 0
+		if self.blocking: self.unblock_peer()
+
+	# Run the Shaper on its own engine, in the calling thread, until stop is called
+	def run(self):
+		if self.engine is None:
+			self.engine = ShaperEngine(name=self.name+"-engine", timeout=self.timeout)
+			self.own_engine = True
+		self.open()
+		self.engine.register(self)
+		if self.inbox: self.signal_inbox() # Forwarded before the start
+		self.engine.run_forever()
 
 	def wake(self):
-		self.wake_sock_client.sendto(self.wake_msg, self.wake_addr)
+		if self.engine is not None: self.engine.wake()
 
 	def set_peer(self, peer):
 		self.peer = peer
 
 	def forward(self, packet):
-		self.log(DEBUG, "forward: packet:", str(packet))
-
-		# Preparing to send
-		self.lock.acquire()
-		self.sending_queue.append(packet)
-		self.wsocks.add(self.sock)
-		self.lock.release()
-
-		# Forcing select to unblock before the timeout
-		self.log(DEBUG, "forward: waking remote thread")
-		self.wake()
-		self.log(DEBUG, "forward: woke remote thread")
+		self.logf(DEBUG, "forward: packet: %s", packet)
+
+		if self.engine is None:
+			# Queued (with the limits and the budget) when the Shaper starts
+			self.inbox.append((time.monotonic(), packet))
+		elif self.engine.in_loop():
+			self.enqueue(packet, time.monotonic())
+			if not self.writing:
+				self.update_writing()
+		else:
+			self.inbox.append((time.monotonic(), packet))
+			self.signal_inbox()
+
+	def signal_inbox(self):
+		if not self.inbox_signaled:
+			self.inbox_signaled = True
+			self.log(DEBUG, "forward: waking remote thread")
+			self.engine.call_soon(self.drain_inbox)
+
+	# Move the packets handed over by another thread to the sending queue (engine thread)
+	def drain_inbox(self):
+		self.inbox_signaled = False
+		inbox = self.inbox
+		while inbox:
+			stamp, packet = inbox.popleft()
+			self.enqueue(packet, stamp)
+		self.update_writing()
+
+	# Put a packet in the sending queue, after the configured latency (engine thread)
+	def enqueue(self, packet, stamp):
+		if not self.admit(packet):
+			return
+		if self.queue_length() >= self.max_queued_packets:
+			self.max_queued_packets = self.queue_length()+1
+		if self.queued_bytes > self.max_queued_bytes:
+			self.max_queued_bytes = self.queued_bytes
+		if not self.latency and not self.jitter:
+			self.sending_queue.append((stamp, packet))
+			return
+		now = time.monotonic()
+		release = now+max(0, self.latency+random.uniform(-self.jitter, self.jitter))
+		# Jitter never reorders packets
+		self.last_release = max(release, self.last_release)
+		self.delayed.append((self.last_release, stamp, packet))
+		if self.delay_timer is None:
+			self.delay_timer = self.engine.call_later(self.last_release-now, self.release_delayed)
+
+	def release_delayed(self):
+		self.delay_timer = None
+		now = time.monotonic()
+		delayed = self.delayed
+		while delayed and delayed[0][0] <= now:
+			self.sending_queue.append(delayed.popleft()[1:])
+		if delayed:
+			self.delay_timer = self.engine.call_later(delayed[0][0]-now, self.release_delayed)
+		self.update_writing()
+
+	def queue_length(self):
+		return len(self.sending_queue)+len(self.delayed)
+
+	def queue_full(self, size):
+		if self.max_packets is not None and self.queue_length() >= self.max_packets:
+			return True
+		return self.max_bytes is not None and self.queued_bytes+size > self.max_bytes
+
+	# Apply the queue limits and the memory budget to a new packet
+	# Return whether the packet should be queued
+	def admit(self, packet):
+		size = len(packet)
+		if self.policy == BLOCK:
+			# The packet was already received: keep it, and stop the producer
+			full = self.queue_full(size)
+			if not self.budget.acquire(size):
+				self.budget.charge(size)
+				full = True
+			if full:
+				self.block_peer()
+			self.queued_bytes += size
+			return True
+
+		if self.policy == DROP_HEAD:
+			while self.queue_full(size) and self.drop_head():
+				self.drops_queue += 1
+		elif self.queue_full(size):
+			self.log(DEBUG, "admit: sending queue is full, dropping packet")
+			self.drops_queue += 1
+			self.total_dropped += 1
+			return False
 
+		while not self.budget.acquire(size):
+			if self.policy != DROP_HEAD or not self.drop_head():
+				self.log(DEBUG, "admit: memory budget exceeded, dropping packet")
+				self.drops_budget += 1
+				self.total_dropped += 1
+				return False
+			self.drops_budget += 1
+		self.queued_bytes += size
+		return True
+
+	# Drop the oldest queued packet, return False if there is none
+	def drop_head(self):
+		if self.sending_queue:
+			packet = self.sending_queue.popleft()[1]
+		elif self.delayed:
+			packet = self.delayed.popleft()[2]
+		else:
+			return False
+		self.dequeued(len(packet))
+		self.total_dropped += 1
+		return True
+
+	# Account for bytes leaving the queue (sent or dropped)
+	def dequeued(self, size):
+		self.queued_bytes -= size
+		self.budget.release(size)
+		if self.blocking and (self.below_low_watermark() or not self.sending_queue and not self.delayed):
+			self.unblock_peer()
+
+	def below_low_watermark(self):
+		if self.max_packets is not None and self.queue_length() > self.max_packets//2:
+			return False
+		if self.max_bytes is not None and self.queued_bytes > self.max_bytes//2:
+			return False
+		return self.budget.limit is None or self.budget.used <= self.budget.limit//2
+
+	def block_peer(self):
+		if self.blocking or self.peer is None: return
+		self.log(DEBUG, "block_peer: sending queue is full, blocking peer")
+		self.blocking = True
+		self.total_blocked += 1
+		self.peer.set_reading(False)
+
+	def unblock_peer(self):
+		self.log(DEBUG, "unblock_peer: unblocking peer")
+		self.blocking = False
+		self.peer.set_reading(True)
+
+	# Enable or disable reading (thread-safe)
+	def set_reading(self, reading):
+		if self.engine is None:
+			self.reading = reading
+		elif self.engine.in_loop():
+			self.engine.set_reading(self, reading)
+		else:
+			self.engine.call_soon(self.engine.set_reading, self, reading)
+
+	# Stop writing until the sending bucket holds enough tokens for the next packet
+	def pace(self, size):
+		self.paced = True
+		self.pacing_timer = self.engine.call_later(self.bucket.delay(size, time.monotonic()), self.resume)
+		self.update_writing()
+
+	def resume(self):
+		self.paced = False
+		self.pacing_timer = None
+		self.update_writing()
+
+	# Whether a packet received from addr is within its address' rate
+	def police(self, addr, size, now):
+		bucket = self.peer_buckets.get(addr)
+		if bucket is None:
+			if len(self.peer_buckets) >= MAX_PEER_BUCKETS:
+				# Forget the oldest address
+				del self.peer_buckets[next(iter(self.peer_buckets))]
+			bucket = self.peer_buckets[addr] = TokenBucket(self.peer_rate, self.peer_burst)
+		return bucket.consume(size, now)
+
+	# The prefix and the arguments are only built when the level is enabled
 	def log(self, lev, *args, **kwargs):
-		log(lev, "["+self.name+"-"+str(threading.current_thread().getName())+"]", *args, **kwargs)
+		if is_enabled(lev, self.log_component):
+			print_log(lev, "["+self.name+"-"+threading.current_thread().name+"]", *args, **kwargs)
+
+	# Same as log, with a message formatted only when emitted (see logs.logf)
+	def logf(self, lev, msg, *args):
+		if is_enabled(lev, self.log_component):
+			print_log(lev, "["+self.name+"-"+threading.current_thread().name+"]", format_log(msg, args))
 
 	# Abstract
 	def prepare(self):
 		pass
 
-	def run(self):
+	def open(self):
 		self.keep_running = True
-
+		self.reading = True
+		if self.sock is not None:
+			self.sock.close()
 		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		if self.reuse_port:
+			self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 		self.prepare()
 		self.sock.setblocking(0)
+		if self.offload:
+			self.enable_offload()
+
+	def enable_offload(self):
+		try:
+			self.sock.setsockopt(socket.SOL_UDP, UDP_GRO, 1)
+		except OSError as err:
+			self.log(WARNING, "enable_offload: UDP GRO is not supported:", err)
+			self.gro = False
+		else:
+			self.gro = True
+		self.gso = True # Checked on the first GSO send
 
-		self.rsocks = set([self.sock, self.wake_sock_listen])
-		self.wsocks = set()
-
-		while self.keep_running:
-			self.log(DEBUG, "run: selecting with len(rsocks)="+str(len(self.rsocks))+" and len(wsocks)="+str(len(self.wsocks)))
-			r, w, _ = select.select(list(self.rsocks), list(self.wsocks), [], self.timeout)
-
-			if len(r)<=0 and len(w)<=0:
-				self.log(DEBUG, "run: data Timeout")
-				continue
-
-			# Browing Read Sockets
-			for s in r:
-				if s == self.wake_sock_listen:
-					self.log(DEBUG, "run: got awaken")
-					self.wake_sock_listen.recvfrom(RECV_BUF_SIZE)
-					continue
-				else:
-					self.handle_read(s)
+	# We only want to write when there is something to send and somebody to send it to
+	def can_write(self):
+		return bool(self.sending_queue) and not self.paced and self.udp_host is not None and self.udp_port is not None
 
-			# Browsing Write Sockets
-			for s in w:
-				self.handle_write(s)
+	def update_writing(self):
+		self.engine.set_writing(self, self.can_write())
 
+	# Receive up to batch_size packets into the engine's buffer, until the socket would block
 	def handle_read(self, s):
-		data, (self.udp_host, self.udp_port) = s.recvfrom(RECV_BUF_SIZE)
-		self.log(DEBUG, "handle_read: received from "+str(self.udp_host)+":"+str(self.udp_port)+", data="+str(data))
+		view = self.engine.recv_view
+		now = time.monotonic()
+		nb = 0
+		host, port = self.udp_host, self.udp_port
+		for _ in range(self.batch_size):
+			try:
+				if self.gro:
+					size, ancdata, _, (self.udp_host, self.udp_port) = s.recvmsg_into([view], GRO_CMSG_SIZE)
+				else:
+					size, (self.udp_host, self.udp_port) = s.recvfrom_into(view)
+			except BlockingIOError:
+				break
+			self.logf(DEBUG, "handle_read: received from %s:%s, size=%d", self.udp_host, self.udp_port, size)
+
+			# With GRO, the buffer may hold several datagrams of the given segment size
+			segment = size
+			if self.gro:
+				for level, kind, data in ancdata:
+					if level == socket.SOL_UDP and kind == UDP_GRO:
+						segment = int.from_bytes(data[:4], sys.byteorder)
+
+			off = 0
+			while True:
+				length = min(segment, size-off)
+				if self.peer_rate is not None and not self.police((self.udp_host, self.udp_port), length, now):
+					self.log(DEBUG, "handle_read: dropped packet above the address rate")
+					self.drops_policed += 1
+					self.total_dropped += 1
+				elif self.handle_packet(bytes(view[off:off+length])):
+					nb += 1
+				off += length
+				if off >= size: break
+		if self.on_address is not None and (self.udp_host != host or self.udp_port != port):
+			self.on_address(self, self.udp_host, self.udp_port)
+		if not self.writing and self.sending_queue:
+			# The UDP peer may just have been registered
+			self.update_writing()
+		return nb
+
+	# Set the UDP peer (engine thread), e.g. learned by the same Shaper in another process
+	def set_udp_peer(self, host, port):
+		self.udp_host = host
+		self.udp_port = port
+		if self.engine is not None and not self.writing and self.sending_queue:
+			self.update_writing()
+
+	def handle_packet(self, data):
 		if data and len(data)>0:
 			self.total_recv += len(data)
+			self.recv_packets += 1
+			if self.capture is not None:
+				self.capture.write(CAPTURE_IN, self.udp_host, self.udp_port, data)
 			try:
 				self.peer.forward(data)
 			except Exception as err:
 				self.log(ERROR, err)
 				return False
 			else:
-				self.log(DEBUG, "handle_read: successfully forwarded packet")
+				self.log(DEBUG, "handle_packet: successfully forwarded packet")
 				return True
 		else:
-			self.log(DEBUG, "handle_read: received empty packet")
+			self.log(DEBUG, "handle_packet: received empty packet")
 			return False
 
+	# Send up to batch_size packets from the sending queue, until the socket would block
 	def handle_write(self, s):
 		if self.udp_host is None or self.udp_port is None:
 			self.log(DEBUG, "UDP peer is not registered")
-		else:
-			self.lock.acquire()
-			data = self.sending_queue.popleft()
-			self.lock.release()
+			self.update_writing()
+			return 0
+
+		addr = (self.udp_host, self.udp_port)
+		now = time.monotonic()
+		nb = 0
+		while nb < self.batch_size and self.sending_queue:
+			if self.gso and len(self.sending_queue) > 1:
+				sent = self.send_segments(s, addr, now, self.batch_size-nb)
+				if sent < 0: break
+				if sent > 0:
+					nb += sent
+					continue
+				# The head packet is sent alone
 
-			self.log(DEBUG, "handle_write: sending to "+str(self.udp_host)+":"+str(self.udp_port)+", data="+str(data))
+			if self.bucket is not None and not self.bucket.consume(len(self.sending_queue[0][1]), now):
+				self.pace(len(self.sending_queue[0][1]))
+				return nb
+			stamp, data = self.sending_queue.popleft()
 
-			sent = s.sendto(data, (self.udp_host, self.udp_port))
+			try:
+				sent = s.sendto(data, addr)
+			except BlockingIOError:
+				sent = 0
+			except OSError as err:
+				# The packet cannot be sent (e.g. ENETUNREACH): drop it
+				self.log(WARNING, "handle_write: failed to send a packet, dropping it:", err)
+				if self.bucket is not None: self.bucket.tokens += len(data)
+				self.total_dropped += 1
+				self.dequeued(len(data))
+				nb += 1
+				continue
 			self.total_sent += sent
 
-			self.log(DEBUG, "handle_write: sent "+str(sent)+" bytes out of "+str(len(data)))
+			self.logf(DEBUG, "handle_write: sent %d bytes out of %d to %s:%s", sent, len(data), self.udp_host, self.udp_port)
 
-			self.lock.acquire()
 			if sent<=0:
 				self.log(DEBUG, "Failed to send data, reinserting")
-				self.sending_queue.appendleft(data)
+				self.sending_queue.appendleft((stamp, data))
+				if self.bucket is not None: self.bucket.tokens += len(data)
+				break
 			elif sent<len(data):
-				self.sending_queue.appendleft(data[sent:])
+				self.sending_queue.appendleft((stamp, data[sent:]))
 			else:
-				if not self.sending_queue:
-					# sendig_queue is empty
-					self.wsocks.remove(s)
-			self.lock.release()
+				self.sent_packets += 1
+				self.latencies.observe(time.monotonic()-stamp)
+				if self.capture is not None:
+					self.capture.write(CAPTURE_OUT, self.udp_host, self.udp_port, data)
+			self.dequeued(sent)
+			nb += 1
+
+		if not self.sending_queue:
+			# sending_queue is empty
+			self.update_writing()
+		return nb
+
+	# Send the packets at the head of the sending queue with a single GSO sendmsg
+	# Segments must have the size of the first packet (only the last one may be smaller)
+	# Return the number of packets sent, -1 if the Shaper should stop writing, or 0 if
+	# the head packet should be sent alone (oversize, or no other packet fits)
+	def send_segments(self, s, addr, now, max_segments):
+		size = len(self.sending_queue[0][1])
+		segments = []
+		total = 0
+		for _, data in self.sending_queue:
+			if len(segments) >= min(max_segments, GSO_MAX_SEGMENTS) or len(data) > size or total+len(data) > GSO_MAX_SIZE:
+				break
+			if self.bucket is not None and not self.bucket.consume(len(data), now):
+				break
+			segments += [ data ]
+			total += len(data)
+			if len(data) < size:
+				break
+
+		if len(segments) < 2:
+			if self.bucket is not None: self.bucket.tokens += total
+			return 0
+
+		try:
+			sent = s.sendmsg(segments, [(socket.SOL_UDP, UDP_SEGMENT, struct.pack("=H", size))], 0, addr)
+		except BlockingIOError:
+			if self.bucket is not None: self.bucket.tokens += total
+			return -1
+		except OSError as err:
+			self.log(WARNING, "send_segments: UDP GSO is not supported, disabling it:", err)
+			if self.bucket is not None: self.bucket.tokens += total
+			self.gso = False
+			return 0
+
+		self.logf(DEBUG, "send_segments: sent %d bytes in %d segments to %s:%s", sent, len(segments), self.udp_host, self.udp_port)
+		self.total_sent += sent
+		end = time.monotonic()
+		for _ in segments:
+			stamp, data = self.sending_queue.popleft()
+			self.sent_packets += 1
+			self.latencies.observe(end-stamp)
+			self.dequeued(len(data))
+			if self.capture is not None:
+				self.capture.write(CAPTURE_OUT, self.udp_host, self.udp_port, data)
+		return len(segments)
 
 	def start_status_timer(self):
-		self.status_timer = threading.Timer(self.status_timeout, self.status_routine)
-		self.status_timer.start()
+		self.status_timer = self.engine.call_later(self.status_timeout, self.status_routine)
 
 	def status_routine(self):
 		self.show_total()
@@ -193,4 +941,24 @@ class Shaper:
 			self.start_status_timer()
 
 	def show_total(self):
-		self.log(INFO, "Shaper: sent: "+str(self.total_sent)+" bytes, received: "+str(self.total_recv)+" bytes")
+		self.log(INFO, "Shaper: sent: "+str(self.total_sent)+" bytes, received: "+str(self.total_recv)+" bytes, dropped: "+str(self.total_dropped)+" packets")
+
+	# Counters of the Shaper (may be called from any thread)
+	def get_stats(self):
+		return {
+			"name": self.name,
+			"sent_packets": self.sent_packets,
+			"sent_bytes": self.total_sent,
+			"recv_packets": self.recv_packets,
+			"recv_bytes": self.total_recv,
+			"dropped": self.total_dropped,
+			"drops_policed": self.drops_policed,
+			"drops_queue": self.drops_queue,
+			"drops_budget": self.drops_budget,
+			"blocked": self.total_blocked,
+			"queue_packets": self.queue_length(),
+			"queue_bytes": self.queued_bytes,
+			"queue_packets_max": self.max_queued_packets,
+			"queue_bytes_max": self.max_queued_bytes,
+			"latency": self.latencies.get()
+		}
@@ -0,0 +1,181 @@
+# External
+import multiprocessing, multiprocessing.connection, os, threading
+
+# Internal
+from common.utils.logs import *
+
+# Serve the same Shaper addresses from several worker processes
+# Every worker builds its own Shapers with factory(shard) (a list of Shapers, already
+# paired with set_peer). Their sockets are opened with SO_REUSEPORT so the kernel
+# hashes the UDP flows across the workers. The supervisor (this object, in the parent
+# process) aggregates the counters of the workers and propagates stop().
+# The two directions of a relay are usually hashed to different workers: the UDP peers
+# learned by a worker are relayed by the supervisor to the Shapers of the same name in
+# the other workers, so that every worker can forward the packets of every flow.
+class ShaperShards:
+	def __init__(self, factory, workers=None, name="ShaperShards", status_timeout=21600):
+		self.factory = factory
+		self.nb_workers = os.cpu_count() if workers is None else workers
+		self.name = name
+		self.log_component = "shaper."+name
+		self.workers = [] # (process, connection)
+		self.address_conns = [] # Connections receiving the UDP peers learned by the workers
+		self.relay_thread = None
+		self.lock = threading.Lock()
+		self.keep_running = False
+
+		# Status
+		self.status_timer = None
+		self.status_timeout = status_timeout
+
+	def log(self, lev, *args, **kwargs):
+		if is_enabled(lev, self.log_component):
+			print_log(lev, "["+self.name+"]", *args, **kwargs)
+
+	def start(self, show_status=True):
+		self.keep_running = True
+		for shard in range(self.nb_workers):
+			conn, child_conn = multiprocessing.Pipe()
+			address_conn, child_address_conn = multiprocessing.Pipe()
+			process = multiprocessing.Process(target=worker_main, args=(self.factory, shard, child_conn, child_address_conn), name=self.name+"-"+str(shard))
+			process.start()
+			child_conn.close()
+			child_address_conn.close()
+			self.workers += [ (process, conn) ]
+			self.address_conns += [ address_conn ]
+		processes = { conn: process for (process, _), conn in zip(self.workers, self.address_conns) }
+		self.relay_thread = threading.Thread(target=self.relay_addresses, args=(processes,), name=self.name+"-relay", daemon=True)
+		self.relay_thread.start()
+
+		if show_status:
+			self.start_status_timer()
+
+	def stop(self, timeout=10):
+		self.keep_running = False
+		if self.status_timer is not None: self.status_timer.cancel()
+		with self.lock:
+			for process, conn in self.workers:
+				try:
+					conn.send("stop")
+				except OSError:
+					pass
+			for process, conn in self.workers:
+				process.join(timeout)
+				if process.is_alive():
+					self.log(WARNING, "stop: worker "+process.name+" did not stop, terminating it")
+					process.terminate()
+					process.join()
+				conn.close()
+			self.workers = []
+		if self.relay_thread is not None:
+			self.relay_thread.join()
+			self.relay_thread = None
+		for conn in self.address_conns:
+			conn.close()
+		self.address_conns = []
+
+	# Relay the UDP peers learned by each worker to the other ones (until they all stopped)
+	# processes: address connection -> worker process
+	def relay_addresses(self, processes):
+		alive = list(processes)
+		while alive:
+			for conn in multiprocessing.connection.wait(alive, timeout=1):
+				try:
+					address = conn.recv()
+				except (EOFError, OSError):
+					alive.remove(conn)
+					continue
+				for other in alive:
+					if other is conn or not processes[other].is_alive(): continue
+					try:
+						other.send(address)
+					except OSError:
+						pass
+			alive = [ conn for conn in alive if processes[conn].is_alive() or conn.poll() ]
+
+	# Counters of every worker (None for the workers that did not answer)
+	def get_workers_stats(self, timeout=5):
+		res = []
+		with self.lock:
+			for process, conn in self.workers:
+				try:
+					conn.send("stats")
+					res += [ conn.recv() if conn.poll(timeout) else None ]
+				except (OSError, EOFError):
+					res += [ None ]
+		return res
+
+	# Counters of all the Shapers of all the workers, summed by Shaper name
+	def get_stats(self, timeout=5):
+		shapers = {}
+		for stats in self.get_workers_stats(timeout=timeout):
+			for shaper in stats or []:
+				total = shapers.setdefault(shaper["name"], {"name": shaper["name"]})
+				for key, value in shaper.items():
+					if not isinstance(value, int): continue
+					if key.endswith("_max"):
+						total[key] = max(total.get(key, 0), value)
+					else:
+						total[key] = total.get(key, 0) + value
+		return list(shapers.values())
+
+	def get_total(self, timeout=5):
+		stats = self.get_stats(timeout=timeout)
+		return sum([ s["sent_bytes"] for s in stats ]), sum([ s["recv_bytes"] for s in stats ])
+
+	def start_status_timer(self):
+		self.status_timer = threading.Timer(self.status_timeout, self.status_routine)
+		self.status_timer.daemon = True
+		self.status_timer.start()
+
+	def status_routine(self):
+		self.show_total()
+		if self.keep_running:
+			self.start_status_timer()
+
+	def show_total(self):
+		total_sent, total_recv = self.get_total()
+		self.log(INFO, "ShaperShards: sent: "+str(total_sent)+" bytes, received: "+str(total_recv)+" bytes")
+
+# Worker process: run the Shapers of a shard until the supervisor asks to stop
+def worker_main(factory, shard, conn, address_conn):
+	shapers = factory(shard)
+	by_name = { shaper.name: shaper for shaper in shapers }
+	send_lock = threading.Lock()
+	def address_learned(shaper, host, port):
+		with send_lock:
+			try:
+				address_conn.send((shaper.name, host, port))
+			except OSError:
+				pass
+	def receive_addresses():
+		while True:
+			try:
+				name, host, port = address_conn.recv()
+			except (EOFError, OSError):
+				return
+			shaper = by_name.get(name)
+			if shaper is not None and shaper.engine is not None:
+				shaper.engine.call_soon(shaper.set_udp_peer, host, port)
+	for shaper in shapers:
+		shaper.reuse_port = True
+		shaper.on_address = address_learned
+		shaper.start(show_status=False)
+	threading.Thread(target=receive_addresses, daemon=True).start()
+	try:
+		while True:
+			try:
+				msg = conn.recv()
+			except EOFError:
+				break # The supervisor is gone
+			if msg == "stats":
+				conn.send([ shaper.get_stats() for shaper in shapers ])
+			elif msg == "stop":
+				break
+	except KeyboardInterrupt:
+		pass
+	finally:
+		for shaper in shapers:
+			shaper.stop()
+		conn.close()
+		address_conn.close()
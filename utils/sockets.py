@@ -1,13 +1,32 @@
 # External
-import os, pickle, socket, sys
+import fcntl, itertools, mmap, os, pickle, selectors, socket, stat, sys, threading, time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
 
 # Internal
+from common.utils.instrument import instrumentation
 from common.utils.logs import *
+from common.utils.serializers import *
 
 # CONSTANTS
 global OBJECT_SIZE, COMMAND_SIZE
 OBJECT_SIZE = 4 # Objects size encoded on 4 bytes
 COMMAND_SIZE = 1 # Commands encoded on 1 bytes
+TAG_SIZE = 1 # Once negotiated, objects sizes are followed by a tag (codec and flags) on 1 byte
+RECV_BUFFER_MAX = 16*1024*1024 # Bigger receive buffers are not kept between two frames
+COMPRESS_THRESHOLD = 16*1024 # Smaller payloads are never compressed
+STREAM_CHUNK_SIZE = 1024*1024 # Size of the chunks read from files by send_stream
+REQUEST_ID_SIZE = 4 # Requests identifiers of multiplexed connections encoded on 4 bytes
+READ_AHEAD_SIZE = 64*1024 # Bytes read at once by recv_cmd (the command and what follows it)
+SHM_THRESHOLD = 1024*1024 # Smaller payloads are never sent in shared memory
+SHM_SIZE = 8 # Size of the shared memory payloads encoded on 8 bytes
+SHM_SEALS = getattr(fcntl, "F_SEAL_SHRINK", 0) | getattr(fcntl, "F_SEAL_GROW", 0) | getattr(fcntl, "F_SEAL_WRITE", 0) # Seals of the memory files (their content can not change once sent)
+MAX_FDS = 253 # Maximum number of file descriptors passed at once (SCM_MAX_FD)
+IOV_MAX = os.sysconf("SC_IOV_MAX") if "SC_IOV_MAX" in os.sysconf_names else 1024 # Maximum number of buffers per vectored write
+
+# Reserved command used to negotiate the features of a connection (see ProtoSocket.negotiate)
+CMD_NEGOTIATE = 255
+NEGOTIATE_ACK = "negotiate" # Answer of the peers supporting the negotiation to CMD_NEGOTIATE
 
 # There are two kinds of clients / servers:
 #	- TCLIENT: Transport (Transport-level) Client
@@ -29,6 +48,61 @@ class ProtoSocket:
 	def __init__(self):
 		self.socket = None
 		self.name = None
+		self.recv_buffer = bytearray(4096) # Reused for every frame received
+		self.send_lock = threading.Lock() # Frames are written by one thread at a time
+		# Held by the HCLIENT side while a lock-step exchange waits for its answer
+		# (reentrant: request_once may run within an exchange, through submit)
+		self.exchange_lock = threading.RLock()
+		self.read_ahead = bytearray() # Bytes received ahead by recv_cmd, consumed first by the next receives
+		self.received_fds = deque() # File descriptors received ahead (AF_UNIX), consumed by recv_fds and recv_frame
+
+		# TCP options (see set_nodelay, set_quickack and set_keepalive)
+		self.nodelay = False
+		self.quickack = False
+		self.keepalive = None # (idle, interval, count, user_timeout)
+		self.last_recv = 0 # Time of the last receive (time.monotonic)
+
+		# Traffic counters of the socket (all its connections)
+		self.bytes_sent = 0
+		self.bytes_recv = 0
+		self.encode_time = 0 # Seconds spent encoding objects
+
+		# Features of the connection, negotiated with the peer (reset when the connection is closed)
+		# Before the negotiation, objects are sent in the legacy format (pickle without tag)
+		self.framed = False
+		self.codecs = [] # Codecs accepted by both sides, by order of preference
+		self.allowed_codecs = None # Names of the codecs this side accepts (None for all the available ones)
+		self.compressor = None # Compressor used for the payloads bigger than compress_threshold
+		self.allowed_compressors = None # Names of the compressors this side accepts (None for all, [] for none)
+		self.compress_threshold = COMPRESS_THRESHOLD
+
+		# Multiplexing: requests (commands and data) are sent in a single frame with an identifier,
+		# answers carry the identifier of their request, so that several requests can be in flight
+		self.multiplex = False # HCLIENT: offer multiplexing
+		self.allow_multiplex = True # HSERVER: accept multiplexing
+		self.multiplexed = False
+		self.request_id = None # HSERVER: identifier of the request being handled
+		self.pending_commands = deque() # HSERVER: commands of the request being handled
+		self.pending_data = None # HSERVER: data of the request being handled
+		self.futures = {} # HCLIENT: request identifier -> Future of the answer
+		self.futures_lock = threading.Lock()
+		self.request_ids = itertools.count(1)
+		self.reader = None # HCLIENT: thread reading the answers
+
+		# Shared memory: on AF_UNIX connections, big payloads are written to a memory file
+		# passed to the peer (SCM_RIGHTS), which maps it instead of receiving the payload
+		self.allow_shm = True
+		self.shm = False
+		self.shm_threshold = SHM_THRESHOLD
+
+		# Compression statistics of the connection
+		self.compression_stats = {
+			"compressed_frames": 0,
+			"raw_bytes": 0, # Size of the compressed payloads before compression
+			"compressed_bytes": 0, # Size of the compressed payloads after compression
+			"compress_time": 0, # Seconds spent compressing (including the payloads left uncompressed)
+			"decompress_time": 0
+		}
 
 	# Get the class name to generate logs (this class is abstract for Door and VM sockets)
 	def get_name(self):
@@ -37,30 +111,156 @@ class ProtoSocket:
 	def set_name(self, name):
 		self.name = name
 
+	# Log a message of a method, e.g. self.log(DEBUG, "recv: received %d bytes", size): the
+	# message is only built when the level is enabled for the component "sockets.<name>"
+	def log(self, level, msg, *args):
+		name = self.get_name()
+		if is_enabled(level, "sockets."+name if COMPONENT_LEVELS else None):
+			print_log(level, name+"."+format_log(msg, args))
+
 	def connected(self):
 		return self.socket is not None
 
 	def close(self):
-		if self.socket is not None: self.socket.close()
+		reader = self.reader
+		if self.socket is not None and reader is not None and reader is not threading.current_thread():
+			# Unblock the thread reading the answers and wait for it to fail the requests in flight
+			try:
+				self.socket.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+			reader.join(timeout=5)
+		sock = self.socket
+		# Reset before the socket is dropped: a thread seeing the connection closed may reopen it
+		self.reset_features()
 		self.socket = None
+		if sock is not None: sock.close()
+
+	# Make the current and next receives fail (may be called from any thread while another one
+	# is blocked on the socket): the connection is then closed by the receiving side
+	def abort(self):
+		sock = self.socket
+		if sock is None: return
+		try:
+			sock.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
 
 	# Send an object (object size on OBJECT_SIZE bytes followed by the object on the corresponding amount of bytes)
 	def send_obj(self, obj):
 		if not self.connected():
 			log(ERROR, self.get_name()+".send_obj: Failed to send an object. The socket is not connected")
 			return 0
+		elif self.framed:
+			start = time.perf_counter()
+			codec = self.pick_codec(obj)
+			tag, buffers = self.compress(codec.id, codec.encode(obj))
+			self.encode_time += time.perf_counter()-start
+			return self.send_frame(tag, buffers, request_id=self.request_id if self.multiplexed else None)
+		buffers = self.encode_obj(obj)
+		if buffers is None: return 0
+		return self.send_buffers(buffers)
+
+	# Buffers to send for an object, in the format of the connection (None on failure)
+	def encode_obj(self, obj):
+		start = time.perf_counter()
+		if self.framed:
+			codec = self.pick_codec(obj)
+			tag, buffers = self.compress(codec.id, codec.encode(obj))
+			buffers = self.frame_buffers(tag, buffers, request_id=self.request_id if self.multiplexed else None)
 		else:
-			return self.send(serialize(obj))
+			header, serial = serialize_frame(obj)
+			buffers = None if header is None else [header, serial]
+		self.encode_time += time.perf_counter()-start
+		return buffers
+
+	# Commands and objects to send with a single write (see CommandBatch)
+	def batch(self):
+		return CommandBatch(self)
 
 	# Receive an object (object size on OBJECT_SIZE bytes followed by the object on the corresponding amount of bytes)
 	def recv_obj(self, timeout=30):
-		bytlen = self.recv(size=OBJECT_SIZE, timeout=timeout)
+		if self.pending_data is not None:
+			# HSERVER: data of a multiplexed request
+			data, self.pending_data = self.pending_data, None
+			return data
+		if self.framed:
+			frame = self.recv_frame(timeout=timeout)
+			return None if frame is None else self.decode_frame(frame[0], frame[1])
+		bytlen = self.recv_exact(OBJECT_SIZE, timeout=timeout)
 		if bytlen is not None:
-			bytobj = self.recv(size=bytes_to_int(bytlen), timeout=timeout)
+			bytobj = self.recv_exact(bytes_to_int(bytlen), timeout=timeout)
 			if bytobj is not None:
 				return deserialize(bytobj)
 		return None
 
+	# Send a stream: an iterable of bytes-like chunks, or the path of a file to send
+	# Chunks are sent one by one (each send blocks until the socket accepts it), so the
+	# memory used does not depend on the size of the stream
+	# Return the number of bytes of the stream sent (None on failure)
+	def send_stream(self, chunks, chunk_size=STREAM_CHUNK_SIZE):
+		if not self.connected():
+			log(ERROR, self.get_name()+".send_stream: Failed to send a stream. The socket is not connected")
+			return None
+		if isinstance(chunks, (str, os.PathLike)):
+			chunks = read_chunks(chunks, chunk_size)
+		total = 0
+		for chunk in chunks:
+			chunk = memoryview(chunk).cast("B")
+			# Frames sizes are limited to OBJECT_SIZE bytes
+			for off in range(0, len(chunk), chunk_size):
+				if self.send_chunk(chunk[off:off+chunk_size]) <= 0:
+					return None
+				total += len(chunk[off:off+chunk_size])
+		if self.send_chunk(b"") <= 0:
+			return None
+		return total
+
+	# Chunks are frames flagged FLAG_STREAM (legacy format: bytes objects, b"" ends the stream)
+	def send_chunk(self, chunk):
+		if not self.framed:
+			return self.send_obj(bytes(chunk))
+		tag, buffers = self.compress(FLAG_STREAM, [ chunk ]) if len(chunk) > 0 else (FLAG_STREAM, [])
+		return self.send_frame(tag, buffers)
+
+	# Receive a stream, chunk by chunk (generator of bytes objects)
+	# The generator stops at the end of the stream, or on failure (the socket is then closed)
+	def iter_stream(self, timeout=30):
+		while True:
+			chunk = self.recv_chunk(timeout=timeout)
+			if chunk is None or len(chunk) == 0: return
+			yield bytes(chunk)
+
+	# Receive a stream into a file
+	# Return the number of bytes received (None on failure)
+	def recv_stream(self, path, timeout=30):
+		total = 0
+		with open(path, "wb") as file:
+			while True:
+				chunk = self.recv_chunk(timeout=timeout)
+				if chunk is None: return None
+				if len(chunk) == 0: return total
+				file.write(chunk)
+				total += len(chunk)
+
+	# Return a chunk (a memoryview only valid until the next receive), or None on failure
+	def recv_chunk(self, timeout=30):
+		if not self.framed:
+			chunk = self.recv_obj(timeout=timeout)
+			if not isinstance(chunk, bytes):
+				log(ERROR, self.get_name()+".recv_chunk: received an invalid chunk")
+				self.close()
+				return None
+			return chunk
+		frame = self.recv_frame(timeout=timeout)
+		if frame is None: return None
+		tag, payload, _ = frame
+		if not tag & FLAG_STREAM:
+			log(ERROR, self.get_name()+".recv_chunk: expected a stream chunk")
+			self.close()
+			return None
+		return self.decompress(payload) if tag & FLAG_COMPRESSED else payload
+
 	# Send a command (should be on COMMAND_SIZE bytes)
 	def send_cmd(self, cmd):
 		if not self.connected():
@@ -74,13 +274,445 @@ class ProtoSocket:
 		if not self.connected():
 			log(ERROR, self.get_name()+".recv_cmd: Failed to send a command. The socket is not connected")
 			return None
+		elif self.pending_commands:
+			return self.pending_commands.popleft()
+		elif self.multiplexed:
+			# The commands come from the requests, handled one after the other
+			while not self.pending_commands:
+				request = self.recv_request()
+				if request is None: return None
+				self.request_id, commands, self.pending_data = request
+				self.pending_commands.extend(commands)
+			return self.pending_commands.popleft()
 		else:
+			if not self.read_ahead:
+				# A single read gets the command and what follows it (commands and objects
+				# batched by the HCLIENT)
+				if not self.fill_read_ahead(): return None
 			bytes_cmd = self.recv(size=COMMAND_SIZE)
 			if bytes_cmd:
-				return bytes_to_int(bytes_cmd)
+				cmd = bytes_to_int(bytes_cmd)
+				if cmd == CMD_NEGOTIATE:
+					# Handled here, the caller gets the next command
+					self.accept_negotiation()
+					return self.recv_cmd()
+				return cmd
 			else:
 				return None
 
+	# Send a frame (negotiated format): size on OBJECT_SIZE bytes, tag on TAG_SIZE bytes, payload
+	# The request identifier, if any, is written before the payload (it is never compressed)
+	def send_frame(self, tag, buffers, request_id=None):
+		if self.shm and sum([ memoryview(buf).nbytes for buf in buffers ]) >= self.shm_threshold:
+			return self.send_shm_frame(tag, buffers, request_id=request_id)
+		buffers = self.frame_buffers(tag, buffers, request_id=request_id)
+		if buffers is None: return 0
+		return self.send_buffers(buffers)
+
+	# Buffers of a frame (None if the payload is too big)
+	def frame_buffers(self, tag, buffers, request_id=None):
+		if request_id is not None:
+			tag |= FLAG_REQUEST_ID
+			buffers = [ request_id.to_bytes(REQUEST_ID_SIZE, 'big') ] + buffers
+		length = sum([ memoryview(buf).nbytes for buf in buffers ])
+		header = to_nb_bytes(length, OBJECT_SIZE)
+		if len(header) != OBJECT_SIZE: return None
+		return [ header+tag.to_bytes(TAG_SIZE, 'big') ] + buffers
+
+	# Receive a frame (negotiated format)
+	# Return (tag, payload, request identifier or None) or None
+	def recv_frame(self, timeout=30):
+		while self.shm and len(self.read_ahead) < OBJECT_SIZE+TAG_SIZE:
+			# The memory files come with the frame headers: read them with the file descriptors
+			if not self.fill_read_ahead(timeout=timeout): return None
+		header = self.recv_exact(OBJECT_SIZE+TAG_SIZE, timeout=timeout)
+		if header is None: return None
+		length = bytes_to_int(header[:OBJECT_SIZE])
+		tag = header[OBJECT_SIZE]
+		codec = CODECS_BY_ID.get(tag & CODEC_MASK)
+		if codec is None:
+			log(ERROR, self.get_name()+".recv_frame: received a frame with an unknown codec")
+			self.close()
+			return None
+		payload = self.recv_exact(length, timeout=timeout, owned=codec.owns_buffer or tag & FLAG_SHM)
+		if payload is None: return None
+		request_id = None
+		if tag & FLAG_REQUEST_ID:
+			request_id = bytes_to_int(payload[:REQUEST_ID_SIZE])
+			payload = payload[REQUEST_ID_SIZE:]
+		if tag & FLAG_SHM:
+			payload = self.map_shm(bytes_to_int(payload[:SHM_SIZE]))
+			if payload is None: return None
+		return tag, payload, request_id
+
+	# Send a frame whose payload is written to a memory file passed to the peer
+	# The frame only contains the size of the payload
+	def send_shm_frame(self, tag, buffers, request_id=None):
+		size = sum([ memoryview(buf).nbytes for buf in buffers ])
+		try:
+			fd = os.memfd_create("honeywalt-frame", os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING)
+		except OSError as err:
+			log(WARNING, self.get_name()+".send_shm_frame: failed to create a memory file:", err)
+			return self.send_buffers(self.frame_buffers(tag, buffers, request_id=request_id))
+		try:
+			os.ftruncate(fd, size)
+			with mmap.mmap(fd, size) as shm:
+				off = 0
+				for buf in buffers:
+					view = memoryview(buf).cast("B")
+					shm[off:off+view.nbytes] = view
+					off += view.nbytes
+			# Sealed once unmapped (no writable mapping may remain), before the peer maps it
+			fcntl.fcntl(fd, fcntl.F_ADD_SEALS, SHM_SEALS)
+			header = self.frame_buffers(tag | FLAG_SHM, [ size.to_bytes(SHM_SIZE, 'big') ], request_id=request_id)
+			with self.send_lock:
+				self.bytes_sent += socket.send_fds(self.socket, header, [fd])
+		except OSError as err:
+			log(WARNING, self.get_name()+".send_shm_frame: failed to send a frame:", err)
+			return 0
+		finally:
+			os.close(fd)
+		return size
+
+	# Map the memory file received with a frame
+	# The file must be sealed and big enough: otherwise the peer could change its content
+	# while it is read, or truncate it under the mapping
+	# Return a read-only memoryview on its content, or None
+	def map_shm(self, size):
+		if not self.received_fds:
+			log(ERROR, self.get_name()+".map_shm: received a shared memory frame without memory file")
+			self.close()
+			return None
+		fd = self.received_fds.popleft()
+		try:
+			if fcntl.fcntl(fd, fcntl.F_GET_SEALS) & SHM_SEALS != SHM_SEALS:
+				log(ERROR, self.get_name()+".map_shm: received a memory file which is not sealed")
+				self.close()
+				return None
+			if os.fstat(fd).st_size < size:
+				log(ERROR, self.get_name()+".map_shm: received a memory file smaller than the frame")
+				self.close()
+				return None
+			return memoryview(mmap.mmap(fd, size, prot=mmap.PROT_READ))
+		except (OSError, ValueError) as err:
+			log(ERROR, self.get_name()+".map_shm: failed to map the memory file:", err)
+			self.close()
+			return None
+		finally:
+			os.close(fd)
+
+	# Send open file descriptors to the peer (AF_UNIX only), to be received with recv_fds
+	# The descriptors stay open on this side
+	# Return the number of bytes sent, 0 on failure
+	def send_fds(self, fds):
+		if not self.connected():
+			log(ERROR, self.get_name()+".send_fds: Failed to send file descriptors. The socket is not connected")
+			return 0
+		if not 0 < len(fds) <= MAX_FDS:
+			log(ERROR, self.get_name()+".send_fds: can only send 1 to "+str(MAX_FDS)+" file descriptors at once")
+			return 0
+		try:
+			with self.send_lock:
+				return socket.send_fds(self.socket, [ bytes([len(fds)]) ], fds)
+		except OSError as err:
+			log(WARNING, self.get_name()+".send_fds: failed to send file descriptors:", err)
+			return 0
+
+	# Receive the file descriptors sent by send_fds (the caller has to close them)
+	# Return the list of file descriptors, or None
+	def recv_fds(self, timeout=30):
+		if not self.connected(): return None
+		if not self.read_ahead and not self.fill_read_ahead(timeout=timeout): return None
+		nb = self.read_ahead[0]
+		del self.read_ahead[:1]
+		if len(self.received_fds) < nb:
+			log(ERROR, self.get_name()+".recv_fds: did not receive the file descriptors")
+			self.close()
+			return None
+		return [ self.received_fds.popleft() for _ in range(nb) ]
+
+	# Read the bytes available (at most READ_AHEAD_SIZE) when the read-ahead buffer is empty
+	# On AF_UNIX connections (where they are appended to the read-ahead buffer, even if it
+	# is not empty), the file descriptors received are kept in received_fds
+	# Return False on failure (the socket is then closed)
+	def fill_read_ahead(self, timeout=30):
+		if self.socket.family != socket.AF_UNIX:
+			data = self.recv(size=READ_AHEAD_SIZE, timeout=timeout)
+			if not data: return False
+			self.read_ahead += data
+			return True
+		self.socket.settimeout(timeout)
+		try:
+			data, fds, _, _ = socket.recv_fds(self.socket, READ_AHEAD_SIZE, MAX_FDS)
+		except socket.timeout:
+			self.log(WARNING, "fill_read_ahead: reached timeout")
+			self.close()
+			return False
+		except KeyboardInterrupt:
+			self.log(INFO, "fill_read_ahead: received KeyboardInterrupt")
+			self.close()
+			return False
+		except socket.error:
+			self.log(WARNING, "fill_read_ahead: received a connection error")
+			self.close()
+			return False
+		self.received_fds.extend(fds)
+		if not data:
+			self.log(INFO, "fill_read_ahead: Connection terminated")
+			self.close()
+			return False
+		self.read_ahead += data
+		self.bytes_recv += len(data)
+		self.last_recv = time.monotonic()
+		return True
+
+	# HSERVER side of a multiplexed connection: receive a request
+	# Return (request identifier, commands, data) or None
+	def recv_request(self, timeout=30):
+		frame = self.recv_frame(timeout=timeout)
+		if frame is None: return None
+		tag, payload, request_id = frame
+		request = self.decode_frame(tag, payload)
+		if request_id is None or not isinstance(request, dict):
+			log(ERROR, self.get_name()+".recv_request: received an invalid request")
+			self.close()
+			return None
+		return request_id, request.get("commands", []), request.get("data")
+
+	# HSERVER side of a multiplexed connection: handle the requests concurrently
+	# handler(sock) is called by a pool of workers with a RequestSocket: it gets the
+	# commands and data of its request with recv_cmd/recv_obj and answers with send_obj,
+	# just like on a ProtoSocket
+	# The connection is negotiated with the first command: if the HCLIENT does not multiplex,
+	# the handler is called with this socket for each exchange, one after the other
+	# Return when the connection is closed
+	def serve_requests(self, handler, workers=8):
+		if not self.multiplexed:
+			cmd = self.recv_cmd()
+			if cmd is None: return
+			if not self.multiplexed:
+				self.pending_commands.appendleft(cmd)
+				while self.connected():
+					handler(self)
+				return
+			# recv_cmd read the first request
+			self.pending_commands.appendleft(cmd)
+			first = (self.request_id, list(self.pending_commands), self.pending_data)
+			self.pending_commands.clear()
+			self.pending_data = None
+		else:
+			first = None
+		slots = threading.BoundedSemaphore(workers*2) # At most workers requests waiting
+		def run(request):
+			try:
+				handler(RequestSocket(self, *request))
+			except Exception as err:
+				log(ERROR, self.get_name()+".serve_requests: the handler failed:", err)
+			finally:
+				slots.release()
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			while self.connected():
+				request, first = first or self.recv_request(timeout=None), None
+				if request is None: break
+				slots.acquire()
+				executor.submit(run, request)
+
+	# HCLIENT side: send a request
+	# Return a Future of the raw answer (to give to parse_answer), set to None if the connection is lost
+	# On a connection that is not multiplexed, the exchange is run right away
+	def submit(self, commands=[], data=None, timeout=30):
+		future = Future()
+		if not self.multiplexed:
+			future.set_result(self.request_once(commands, data, timeout=timeout))
+			return future
+		request_id = next(self.request_ids) % 2**(8*REQUEST_ID_SIZE)
+		request = {"commands": list(commands)}
+		if data is not None: request["data"] = data
+		start = time.perf_counter()
+		codec = self.pick_codec(request)
+		tag, buffers = self.compress(codec.id, codec.encode(request))
+		self.encode_time += time.perf_counter()-start
+		with self.futures_lock:
+			self.futures[request_id] = future
+		if self.send_frame(tag, buffers, request_id=request_id) <= 0:
+			with self.futures_lock:
+				self.futures.pop(request_id, None)
+			future.set_result(None)
+		return future
+
+	# Legacy (lock-step) exchange, without retry
+	# Return the raw answer or None
+	def request_once(self, commands=[], data=None, timeout=30):
+		with self.exchange_lock:
+			batch = self.batch()
+			for cmd in commands:
+				batch.add_cmd(cmd)
+			if data is not None:
+				batch.add_obj(data)
+			if batch.buffers and batch.send() <= 0: return None
+			return self.recv_obj(timeout=timeout)
+
+	# HCLIENT side of a multiplexed connection: read the answers and complete their futures
+	def read_answers(self, futures):
+		while self.connected():
+			frame = self.recv_frame(timeout=None)
+			if frame is None: break
+			tag, payload, request_id = frame
+			res = self.decode_frame(tag, payload)
+			with self.futures_lock:
+				future = futures.pop(request_id, None)
+			if future is not None:
+				future.set_result(res)
+		# The connection is lost: fail the requests in flight
+		with self.futures_lock:
+			lost = list(futures.values())
+			futures.clear()
+		for future in lost:
+			future.set_result(None)
+
+	def start_reader(self):
+		# The requests in flight on this connection
+		self.futures = {}
+		self.reader = threading.Thread(target=self.read_answers, args=(self.futures,), name=self.get_name()+"-reader", daemon=True)
+		self.reader.start()
+
+	def decode_frame(self, tag, payload):
+		if tag & FLAG_COMPRESSED:
+			payload = self.decompress(payload)
+		return CODECS_BY_ID[tag & CODEC_MASK].decode(payload)
+
+	# Compress the payload of a frame if it is big enough and compression saves space
+	# Return the tag and the buffers to send
+	def compress(self, tag, buffers):
+		if self.compressor is None: return tag, buffers
+		size = sum([ memoryview(buf).nbytes for buf in buffers ])
+		if size < self.compress_threshold: return tag, buffers
+		start = time.perf_counter()
+		compressed = self.compressor.compress(buffers)
+		self.compression_stats["compress_time"] += time.perf_counter()-start
+		if len(compressed) >= size: return tag, buffers
+		self.compression_stats["compressed_frames"] += 1
+		self.compression_stats["raw_bytes"] += size
+		self.compression_stats["compressed_bytes"] += len(compressed)
+		return tag | FLAG_COMPRESSED, [ compressed ]
+
+	def decompress(self, payload):
+		if self.compressor is None:
+			log(ERROR, self.get_name()+".decompress: received a compressed frame but no compressor was negotiated")
+			return payload
+		start = time.perf_counter()
+		payload = memoryview(self.compressor.decompress(payload))
+		self.compression_stats["decompress_time"] += time.perf_counter()-start
+		return payload
+
+	def get_compression_stats(self):
+		stats = dict(self.compression_stats)
+		stats["saved_bytes"] = stats["raw_bytes"]-stats["compressed_bytes"]
+		stats["compressor"] = None if self.compressor is None else self.compressor.name
+		return stats
+
+	# First codec of the connection able to encode obj ("pickle" is always the last one)
+	def pick_codec(self, obj):
+		for codec in self.codecs:
+			if codec.can_encode(obj):
+				return codec
+		return CODECS["pickle"]
+
+	# HCLIENT side: offer the features of the connection to the peer, and use the ones it accepts
+	# The offer is only sent once the peer has acknowledged CMD_NEGOTIATE: a legacy peer
+	# answers it like an unknown command, and the connection stays usable in the legacy
+	# format (legacy_peer is then set). On any other failure (timeout, connection lost,
+	# invalid answer), the connection is closed.
+	def negotiate(self, timeout=5):
+		if self.send_cmd(CMD_NEGOTIATE) == 0: return False
+		ack = self.recv_obj(timeout=timeout)
+		if ack is None:
+			log(WARNING, self.get_name()+".negotiate: no answer to the negotiation")
+			self.close()
+			return False
+		if not isinstance(ack, dict) or ack.get("answer") != NEGOTIATE_ACK:
+			log(WARNING, self.get_name()+".negotiate: the peer does not support the negotiation")
+			self.legacy_peer = True
+			return False
+		if self.send_obj(self.offer_features()) <= 0:
+			return False
+		features = self.get_answer(timeout=timeout)
+		if not isinstance(features, dict):
+			log(WARNING, self.get_name()+".negotiate: received an invalid answer to the offer")
+			self.close()
+			return False
+		self.apply_features(features)
+		if self.multiplexed:
+			self.start_reader()
+		return True
+
+	# HSERVER side: answer a CMD_NEGOTIATE (received by recv_cmd)
+	def accept_negotiation(self):
+		if self.send_obj({"success": True, "answer": NEGOTIATE_ACK}) <= 0:
+			return False
+		offer = self.recv_obj()
+		if not isinstance(offer, dict):
+			log(ERROR, self.get_name()+".accept_negotiation: received an invalid offer")
+			self.close()
+			return False
+		features = self.accept_features(offer)
+		if self.send_obj({"success": True, "answer": features}) <= 0:
+			return False
+		self.apply_features(features)
+		return True
+
+	def local_codecs(self):
+		return [ name for name in available_codecs() if self.allowed_codecs is None or name in self.allowed_codecs ]
+
+	def local_compressors(self):
+		return [ name for name in available_compressors() if self.allowed_compressors is None or name in self.allowed_compressors ]
+
+	# Features offered by the HCLIENT
+	def offer_features(self):
+		return {
+			"codecs": self.local_codecs(),
+			"compressors": self.local_compressors(),
+			"multiplex": self.multiplex,
+			"shm": self.shm_available()
+		}
+
+	# Features accepted by the HSERVER, given the offer of the HCLIENT
+	def accept_features(self, offer):
+		local = self.local_codecs()
+		compressors = [ name for name in offer.get("compressors", []) if name in self.local_compressors() ]
+		shm = bool(offer.get("shm")) and self.shm_available()
+		return {
+			"codecs": [ name for name in offer.get("codecs", []) if name in local ],
+			"compressor": compressors[0] if compressors and not shm else None, # Useless on local connections
+			"multiplex": bool(offer.get("multiplex")) and self.allow_multiplex,
+			"shm": shm
+		}
+
+	def apply_features(self, features):
+		self.codecs = [ CODECS[name] for name in features.get("codecs", []) if name in CODECS ]
+		self.compressor = COMPRESSORS.get(features.get("compressor"))
+		self.multiplexed = bool(features.get("multiplex"))
+		self.shm = bool(features.get("shm"))
+		self.framed = True
+
+	# Shared memory frames need memory files and a local (AF_UNIX) connection
+	def shm_available(self):
+		return self.allow_shm and hasattr(os, "memfd_create") and hasattr(fcntl, "F_ADD_SEALS") and self.connected() and self.socket.family == socket.AF_UNIX
+
+	def reset_features(self):
+		self.framed = False
+		self.codecs = []
+		self.compressor = None
+		self.multiplexed = False
+		self.shm = False
+		self.read_ahead.clear()
+		while self.received_fds:
+			os.close(self.received_fds.popleft())
+		self.request_id = None
+		self.pending_commands.clear()
+		self.pending_data = None
+		self.reader = None
+
 	# get_answer
 	# Print the warnings, errors and fatal errors, get the answer
 	# Return:
@@ -88,7 +720,9 @@ class ProtoSocket:
 	#	- Answer (any kind of object) if it is a success and their is an answer data
 	#	- False if it did not succeed
 	def get_answer(self, timeout=30):
-		res = self.recv_obj(timeout=timeout)
+		return self.parse_answer(self.recv_obj(timeout=timeout))
+
+	def parse_answer(self, res):
 		if not res: # CONNECTION TERMINATED OR KEYBOARD INTERRUPTION
 			return None
 		elif not isinstance(res, dict) or not "success" in res: # INVALID ANSWER 
@@ -114,29 +748,102 @@ class ProtoSocket:
 
 	# Send data to the socket
 	def send(self, bytes_msg):
+		return self.send_buffers([bytes_msg])
+
+	# Send several buffers with vectored writes (no concatenation), until everything is sent
+	# (at most IOV_MAX buffers per write)
+	# Return the number of bytes sent, 0 on failure
+	def send_buffers(self, buffers):
+		views = deque([ memoryview(buf).cast("B") for buf in buffers if memoryview(buf).nbytes > 0 ])
+		total = 0
 		try:
-			nb = self.socket.send(bytes_msg)
+			with self.send_lock:
+				while views:
+					nb = self.socket.sendmsg(list(itertools.islice(views, IOV_MAX)))
+					total += nb
+					while views and nb >= len(views[0]):
+						nb -= len(views[0])
+						views.popleft()
+					if nb > 0:
+						views[0] = views[0][nb:]
+		except OSError as err:
+			self.log(WARNING, "send_buffers: failed to send: %s", err)
+			return 0
 		except:
 			return 0
 		else:
-			return nb
+			self.bytes_sent += total
+			return total
+
+	# Receive exactly size bytes, with a timeout (between two reads)
+	# Return a memoryview on the receive buffer (only valid until the next receive), or None
+	# (or on a new buffer if owned is True: the returned view then stays valid)
+	def recv_exact(self, size, timeout=30, owned=False):
+		if not self.connected(): return None
+		if owned:
+			buf = bytearray(size)
+		elif len(self.recv_buffer) < size:
+			# A new buffer, the views returned before stay valid
+			buf = bytearray(size)
+			if size <= RECV_BUFFER_MAX: self.recv_buffer = buf
+		else:
+			buf = self.recv_buffer
+		view = memoryview(buf)[:size]
+		got = min(size, len(self.read_ahead))
+		if got > 0:
+			view[:got] = self.read_ahead[:got]
+			del self.read_ahead[:got]
+		self.socket.settimeout(timeout)
+		try:
+			while got < size:
+				nb = self.socket.recv_into(view[got:])
+				if nb == 0:
+					self.log(INFO, "recv_exact: Connection terminated")
+					self.close()
+					return None
+				got += nb
+				self.bytes_recv += nb
+			self.last_recv = time.monotonic()
+			if self.quickack: self.set_quickack()
+		except socket.timeout:
+			self.log(WARNING, "recv_exact: reached timeout")
+			self.close()
+			return None
+		except KeyboardInterrupt:
+			self.log(INFO, "recv_exact: received KeyboardInterrupt")
+			self.close()
+			return None
+		except socket.error:
+			self.log(WARNING, "recv_exact: received a connection error")
+			self.close()
+			return None
+		except Exception as err:
+			log(FATAL, self.get_name()+".recv_exact: an unknown error occured")
+			self.close()
+			eprint(self.get_name()+".recv_exact:", err)
+		else:
+			return view
 
 	# Receive data on socket, with a timeout
 	def recv(self, size=2048, timeout=30):
 		if not self.connected(): return None
+		if self.read_ahead:
+			res = bytes(self.read_ahead[:size])
+			del self.read_ahead[:size]
+			return res
 		self.socket.settimeout(timeout)
 		try:
 			res = self.socket.recv(size)
 		except socket.timeout:
-			log(WARNING, self.get_name()+".recv: reached timeout")
+			self.log(WARNING, "recv: reached timeout")
 			self.close()
 			return None
 		except KeyboardInterrupt:
-			log(INFO, self.get_name()+".recv: received KeyboardInterrupt")
+			self.log(INFO, "recv: received KeyboardInterrupt")
 			self.close()
 			return None
 		except socket.error:
-			log(WARNING, self.get_name()+".recv: received a connection error")
+			self.log(WARNING, "recv: received a connection error")
 			self.close()
 			return None
 		except Exception as err:
@@ -145,17 +852,78 @@ class ProtoSocket:
 			eprint(self.get_name()+".recv:", err)
 		else:
 			if not res:
-				log(INFO, self.get_name()+".recv: Connection terminated")
+				self.log(INFO, "recv: Connection terminated")
 				self.close()
 				return None
+			self.bytes_recv += len(res)
+			self.last_recv = time.monotonic()
+			if self.quickack: self.set_quickack()
 			return res
 
+	# Disable (or enable) Nagle's algorithm: small writes are sent right away
+	def set_nodelay(self, enabled=True):
+		self.nodelay = enabled
+		return self.set_tcp_option(socket.TCP_NODELAY, enabled)
+
+	# Acknowledge the received segments right away instead of delaying the ACKs (Linux only)
+	# The kernel may leave the quick ACK mode by itself: when enabled, it is set again
+	# after every receive
+	def set_quickack(self, enabled=True):
+		self.quickack = enabled
+		if not hasattr(socket, "TCP_QUICKACK"): return False
+		return self.set_tcp_option(socket.TCP_QUICKACK, enabled)
+
+	# Detect dead peers at the TCP level: keepalive probes are sent after idle seconds without
+	# traffic, every interval seconds, and the connection fails after count unanswered probes,
+	# or when sent data is not acknowledged for user_timeout seconds (Linux). The receives
+	# blocked on a dead connection then fail without waiting for their timeout.
+	def set_keepalive(self, idle=1, interval=1, count=3, user_timeout=None):
+		self.keepalive = (idle, interval, count, user_timeout)
+		if not self.connected(): return False
+		try:
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+			if hasattr(socket, "TCP_KEEPIDLE"):
+				self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(idle)))
+			self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(interval)))
+			self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, max(1, int(count)))
+			if user_timeout is not None and hasattr(socket, "TCP_USER_TIMEOUT"):
+				self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, int(user_timeout*1000))
+		except OSError:
+			return False
+		return True
+
+	def set_tcp_option(self, option, enabled):
+		if not self.connected(): return False
+		try:
+			self.socket.setsockopt(socket.IPPROTO_TCP, option, 1 if enabled else 0)
+		except OSError:
+			return False
+		return True
+
+	# Apply the TCP options to a new connection
+	def apply_tcp_options(self):
+		if self.nodelay: self.set_nodelay()
+		if self.quickack: self.set_quickack()
+		if self.keepalive is not None: self.set_keepalive(*self.keepalive)
+
 
 def serialize(obj):
+	bytlen, serial = serialize_frame(obj)
+	return serial if bytlen is None else bytlen+serial
+
+# Serialize an object as a frame header (None if the object is too big) and a payload
+def serialize_frame(obj):
 	serial = pickle.dumps(obj)
-	length = len(serial)
-	bytlen = to_nb_bytes(length, OBJECT_SIZE)
-	return bytlen+serial
+	bytlen = to_nb_bytes(len(serial), OBJECT_SIZE)
+	return (bytlen if len(bytlen) == OBJECT_SIZE else None), serial
+
+# Read a file chunk by chunk
+def read_chunks(path, chunk_size=STREAM_CHUNK_SIZE):
+	with open(path, "rb") as file:
+		while True:
+			chunk = file.read(chunk_size)
+			if not chunk: return
+			yield chunk
 
 def deserialize(strg):
 	return pickle.loads(strg)
@@ -166,6 +934,27 @@ def cmd_to_bytes(cmd):
 def bytes_to_int(byt):
 	return int.from_bytes(byt, 'big')
 
+# Remove the socket file of a server that is not running anymore
+# Return False if the path is used (by a running server, or by another kind of file)
+def remove_stale_socket(path):
+	if isinstance(path, str) and path.startswith("\0"): return True # Abstract namespace
+	try:
+		mode = os.stat(path).st_mode
+	except FileNotFoundError:
+		return True
+	if not stat.S_ISSOCK(mode): return False
+	probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		probe.connect(path)
+	except ConnectionRefusedError:
+		os.unlink(path)
+		return True
+	except OSError:
+		return False
+	finally:
+		probe.close()
+	return False
+
 def to_nb_bytes(integer, nb):
 	try:
 		byt = integer.to_bytes(nb, 'big')
@@ -175,11 +964,91 @@ def to_nb_bytes(integer, nb):
 	return byt
 
 
+# Commands and objects sent with a single (vectored) write, read on the other side like
+# separate send_cmd and send_obj calls
+class CommandBatch:
+	def __init__(self, sock):
+		self.socket = sock
+		self.buffers = []
+		self.failed = False
+
+	def add_cmd(self, cmd):
+		self.buffers += [ cmd_to_bytes(cmd) ]
+		return self
+
+	def add_obj(self, obj):
+		buffers = self.socket.encode_obj(obj)
+		if buffers is None: self.failed = True
+		else: self.buffers += buffers
+		return self
+
+	# Return the number of bytes sent, 0 on failure
+	def send(self):
+		if self.failed: return 0
+		if not self.socket.connected():
+			log(ERROR, self.socket.get_name()+".batch: Failed to send a batch. The socket is not connected")
+			return 0
+		return self.socket.send_buffers(self.buffers)
+
+
+# One request of a multiplexed connection, handled by a worker (see ProtoSocket.serve_requests)
+# The answer is sent with the identifier of the request through the connection
+class RequestSocket(ProtoSocket):
+	def __init__(self, parent, request_id, commands, data):
+		ProtoSocket.__init__(self)
+		self.parent = parent
+		self.request_id = request_id
+		self.pending_commands.extend(commands)
+		self.pending_data = data
+
+	def get_name(self):
+		return self.parent.get_name()
+
+	def connected(self):
+		return self.parent.connected()
+
+	def close(self):
+		pass
+
+	def recv_cmd(self):
+		return self.pending_commands.popleft() if self.pending_commands else None
+
+	def recv_obj(self, timeout=30):
+		data, self.pending_data = self.pending_data, None
+		return data
+
+	def send_obj(self, obj):
+		start = time.perf_counter()
+		codec = self.parent.pick_codec(obj)
+		tag, buffers = self.parent.compress(codec.id, codec.encode(obj))
+		self.parent.encode_time += time.perf_counter()-start
+		return self.parent.send_frame(tag, buffers, request_id=self.request_id)
+
+
+# Connection of a client to a ServerSocket serving several clients (see ServerSocket.serve)
+class ServerConnection(ProtoSocket):
+	def __init__(self, server, sock, remaddr):
+		ProtoSocket.__init__(self)
+		self.socket = sock
+		self.remaddr = remaddr
+		self.name = server.name
+		self.allowed_codecs = server.allowed_codecs
+		self.allowed_compressors = server.allowed_compressors
+		self.compress_threshold = server.compress_threshold
+		self.allow_multiplex = server.allow_multiplex
+		self.nodelay = server.nodelay
+		self.quickack = server.quickack
+		self.keepalive = server.keepalive
+		self.apply_tcp_options()
+
+
+# With socktype AF_UNIX, addr is the path of the socket file (port is ignored)
 class ServerSocket(ProtoSocket):
-	def __init__(self, port, addr="", socktype=socket.AF_INET, reusable=False):
+	def __init__(self, port, addr="", socktype=socket.AF_INET, reusable=False, backlog=1):
 		ProtoSocket.__init__(self)
 		self.socktype = socktype
 		self.reusable = reusable
+		self.backlog = backlog # Connections waiting to be accepted
 		self.listen_socket = socket.socket(self.socktype, socket.SOCK_STREAM)
 		if self.reusable:
 			self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -187,6 +1056,14 @@ class ServerSocket(ProtoSocket):
 		self.remaddr = None # Remote Addr
 		self.port = port
 		self.addr = addr
+		self.bound_path = None # AF_UNIX socket file created by bind
+
+		# Clients served concurrently (see serve)
+		self.selector = None
+		self.clients = set()
+		self.handled = deque() # Connections whose handler returned
+		self.wake_socket = None
+		self.serving = False
 
 	def reinit(self):
 		if not self.reusable: return None
@@ -201,14 +1078,27 @@ class ServerSocket(ProtoSocket):
 			self.socket.close()
 		if self.listen_socket is not None:
 			self.listen_socket.close()
+		if self.bound_path is not None:
+			try:
+				os.unlink(self.bound_path)
+			except OSError:
+				pass
 
 	def bind(self):
+		if self.socktype == socket.AF_UNIX:
+			if not remove_stale_socket(self.addr):
+				log(ERROR, self.get_name()+".bind: "+str(self.addr)+" is used by another server")
+				return False
+			address = self.addr
+		else:
+			address = (self.addr, self.port)
 		try:
-			self.listen_socket.bind((self.addr, self.port))
+			self.listen_socket.bind(address)
 		except:
-			log(DEBUG, self.get_name()+".bind: failed to bind socket")
+			self.log(DEBUG, "bind: failed to bind socket")
 			return False
-		self.listen_socket.listen(1)
+		if self.socktype == socket.AF_UNIX: self.bound_path = self.addr
+		self.listen_socket.listen(self.backlog)
 		return True
 
 	# Accept a new client connection
@@ -221,7 +1111,7 @@ class ServerSocket(ProtoSocket):
 			self.listen_socket.settimeout(timeout)
 			self.socket, self.remaddr = self.listen_socket.accept()
 		except KeyboardInterrupt:
-			log(DEBUG, self.get_name()+".accept: received KeyboardInterrupt")
+			self.log(DEBUG, "accept: received KeyboardInterrupt")
 			return None
 		except socket.timeout:
 			return False
@@ -230,59 +1120,226 @@ class ServerSocket(ProtoSocket):
 			log(ERROR, self.get_name()+".accept:", err)
 			return False
 		else:
-			log(INFO, self.get_name()+".accept: accepted a new client")
+			self.log(INFO, "accept: accepted a new client")
+			self.reset_features()
+			self.apply_tcp_options()
 			return True
 
+	# Serve several clients concurrently (the socket must be bound)
+	# The connections are watched by a selector. When a command arrives on a connection,
+	# handler(conn) is called by one of the workers with the ServerConnection (a ProtoSocket):
+	# it receives the command with recv_cmd and answers it as usual. The commands of a
+	# connection are handled one after the other; a connection closed by the handler is dropped.
+	# Return when stop is called or on KeyboardInterrupt
+	def serve(self, handler, workers=8, timeout=5.0):
+		self.selector = selectors.DefaultSelector()
+		wake_recv, self.wake_socket = socket.socketpair()
+		wake_recv.setblocking(False)
+		self.listen_socket.setblocking(False)
+		self.selector.register(self.listen_socket, selectors.EVENT_READ)
+		self.selector.register(wake_recv, selectors.EVENT_READ)
+		self.serving = True
+		executor = ThreadPoolExecutor(max_workers=workers)
+		try:
+			while self.serving:
+				for key, _ in self.selector.select(timeout):
+					if key.fileobj is self.listen_socket:
+						self.accept_client()
+					elif key.fileobj is wake_recv:
+						try:
+							while wake_recv.recv(4096): pass
+						except BlockingIOError:
+							pass
+					else:
+						self.selector.unregister(key.fileobj)
+						executor.submit(self.handle_client, handler, key.data)
+				while self.handled:
+					conn = self.handled.popleft()
+					if not conn.connected():
+						self.clients.discard(conn)
+					elif conn.pending_commands or conn.read_ahead:
+						# Commands already received (multiplexed request or batch)
+						executor.submit(self.handle_client, handler, conn)
+					else:
+						self.selector.register(conn.socket, selectors.EVENT_READ, conn)
+		except KeyboardInterrupt:
+			self.log(DEBUG, "serve: received KeyboardInterrupt")
+		finally:
+			self.serving = False
+			for conn in list(self.clients):
+				conn.close()
+			executor.shutdown(wait=True)
+			self.clients.clear()
+			self.handled.clear()
+			self.selector.close()
+			self.selector = None
+			wake_recv.close()
+			self.wake_socket.close()
+			self.wake_socket = None
+
+	# May be called from any thread (a handler for instance)
+	def stop(self):
+		self.serving = False
+		if self.wake_socket is not None:
+			try:
+				self.wake_socket.send(b"\0")
+			except OSError:
+				pass
+
+	def accept_client(self):
+		try:
+			sock, remaddr = self.listen_socket.accept()
+		except (BlockingIOError, InterruptedError):
+			return
+		except Exception as err:
+			log(ERROR, self.get_name()+".accept_client: failed to accept a connection:", err)
+			return
+		sock.setblocking(True)
+		conn = ServerConnection(self, sock, remaddr)
+		self.clients.add(conn)
+		self.selector.register(sock, selectors.EVENT_READ, conn)
+		self.log(INFO, "accept_client: accepted a new client (%d connected)", len(self.clients))
+
+	def handle_client(self, handler, conn):
+		try:
+			handler(conn)
+		except Exception as err:
+			log(ERROR, self.get_name()+".handle_client: the handler failed:", err)
+			conn.close()
+		finally:
+			self.handled.append(conn)
+			try:
+				self.wake_socket.send(b"\0")
+			except (OSError, AttributeError):
+				pass
+
+	def nb_clients(self):
+		return len(self.clients)
+
 
 class ClientSocket(ProtoSocket):
-	def __init__(self, socktype=socket.AF_INET):
+	def __init__(self, socktype=socket.AF_INET, negotiation=False, multiplex=False):
 		ProtoSocket.__init__(self)
 		self.socktype = socktype
 		self.socket = None
 		self.ip = None
 		self.port = None
 
+		# Negotiate the features of every new connection (unless the server does not support it)
+		# With multiplex, several threads may run exchanges concurrently on the connection
+		self.negotiation = negotiation or multiplex
+		self.multiplex = multiplex
+		self.legacy_peer = False
+		self.connect_lock = threading.Lock()
+
+		# Seconds to wait for a connection to be established (None to wait as long as the system does)
+		self.connect_timeout = None
+
 	def __del__(self):
 		if self.socket is not None:
 			self.socket.close()
 
 	# ip and port are optional but need to be given at least for the first connection
-	def connect(self, ip=None, port=None):
+	# (with AF_UNIX, ip is the path of the socket file and port is ignored)
+	# timeout defaults to connect_timeout
+	def connect(self, ip=None, port=None, timeout=None):
 		self.ip = self.ip if ip is None else ip
 		self.port = self.port if port is None else port
+		self.reset_features()
 		self.socket = socket.socket(self.socktype, socket.SOCK_STREAM)
 		try:
-			self.socket.connect((self.ip, self.port))
+			self.socket.settimeout(self.connect_timeout if timeout is None else timeout)
+			self.socket.connect(self.ip if self.socktype == socket.AF_UNIX else (self.ip, self.port))
 		except:
 			#log(DEBUG, self.get_name()+".connect: failed to connect")
+			self.socket.close()
+			self.socket = None
 			return False
 		else:
+			self.apply_tcp_options()
+			if self.negotiation and not self.legacy_peer and not self.negotiate():
+				# Still open in the legacy format if the server does not support the negotiation
+				if self.legacy_peer: return self.connected()
+				self.close()
+				return False
 			return True
 
 	# Run a complete "command (+subcommands) - data - answer" exchange on a TCLIENT+HCLIENT socket
+	# The exchange is recorded by the instrumentation, under its first command (the
+	# traffic of the exchanges running concurrently on a multiplexed connection may be
+	# counted in the bytes and encoding time of each other)
 	def exchange(self, commands=[], data=None, timeout=30, retry=1):
+		start = time.perf_counter()
+		sent, recv, encode_time = self.bytes_sent, self.bytes_recv, self.encode_time
+		# Routed on the configuration: the features of a lost connection are reset until
+		# it is reopened (and negotiated again)
+		if self.multiplex and not self.legacy_peer:
+			res = self.exchange_multiplexed(commands, data, timeout=timeout, retry=retry)
+		else:
+			with self.exchange_lock:
+				res = self.exchange_lockstep(commands, data, timeout=timeout, retry=retry)
+		if instrumentation.enabled and commands:
+			instrumentation.record(commands[0],
+				calls=1,
+				errors=int(res is None or res is False),
+				round_trip=time.perf_counter()-start,
+				serialize_time=self.encode_time-encode_time,
+				sent_bytes=self.bytes_sent-sent,
+				recv_bytes=self.bytes_recv-recv
+			)
+		return res
+
+	def exchange_lockstep(self, commands=[], data=None, timeout=30, retry=1):
 		res = None
 		trials = 0
 		reconnect = False
 		while trials <= retry:
 			trials += 1
 			if reconnect:
-				self.close()
-				if not self.connect(): return None
+				with self.connect_lock:
+					self.close()
+					if not self.connect(): return None
 				reconnect = False
+				if self.multiplexed:
+					# The server multiplexes the new connection: the commands must be sent as a request
+					try:
+						return self.parse_answer(self.submit(commands, data, timeout=timeout).result(timeout=timeout))
+					except FutureTimeout:
+						return None
+			# The commands and the data are sent with a single write
+			batch = self.batch()
 			for cmd in commands:
-				if self.send_cmd(cmd) == 0:
-					reconnect = True
-					break
-			else:
-				if data is not None and self.send_obj(data) <= 0:
-					reconnect = True
-					continue
-				res = self.get_answer(timeout=timeout)
-				if res is None: reconnect = True
-				else: break
+				batch.add_cmd(cmd)
+			if data is not None:
+				batch.add_obj(data)
+			if batch.buffers and batch.send() <= 0:
+				reconnect = True
+				continue
+			res = self.get_answer(timeout=timeout)
+			if res is None: reconnect = True
+			else: break
 		return res
 
+	# Exchange on a multiplexed connection: the other requests in flight are not disturbed,
+	# the connection is only reopened when it is lost
+	# Lock-step exchange if the server does not support multiplexing
+	def exchange_multiplexed(self, commands=[], data=None, timeout=30, retry=1):
+		for attempt in range(retry+1):
+			with self.connect_lock:
+				if not self.connected() and not self.connect(): return None
+			if not self.multiplexed:
+				with self.exchange_lock:
+					return self.exchange_lockstep(commands, data, timeout=timeout, retry=retry-attempt)
+			future = self.submit(commands, data, timeout=timeout)
+			try:
+				res = future.result(timeout=timeout)
+			except FutureTimeout:
+				log(ERROR, self.get_name()+".exchange: no answer received before the timeout")
+				return None
+			if res is not None:
+				return self.parse_answer(res)
+		return None
+
 	# Overrides the ProtoSocket send_cmd method
 	# Tries to reconnect to the server if we fail to send the command
 	# By default, we only try to reconnect once.
@@ -1,4 +1,5 @@
 global CONTROL_PORT, VM_COMMANDS, COMMIT_PHASE, RUN_PHASE, DEBUG_PHASE
+global VM_CACHEABLE, VM_INVALIDATIONS, VM_PHASE_DEPENDENT
 global CMD_VM_PHASE, CMD_VM_HONEYPOTS, CMD_VM_IPS, CMD_VM_WG_KEYGEN, CMD_VM_WG_DOORS, CMD_VM_WG_UP, CMD_VM_WG_DOWN, CMD_VM_FW_UP, CMD_VM_FW_DOWN, CMD_VM_COMMIT, CMD_VM_SHUTDOWN, CMD_VM_LIVE
 
 CONTROL_PORT = 5555
@@ -37,4 +38,22 @@ VM_COMMANDS = {
 
 COMMIT_PHASE = 1
 RUN_PHASE = 2
-DEBUG_PHASE = 3
\ No newline at end of file
+DEBUG_PHASE = 3
+
+# Commands whose answers may be cached (see Controller.set_cacheable)
+VM_CACHEABLE = [CMD_VM_PHASE, CMD_VM_HONEYPOTS, CMD_VM_IPS]
+
+# Commands changing the state of the VM -> commands whose cached answers they invalidate
+VM_INVALIDATIONS = {
+CMD_VM_WG_KEYGEN:[CMD_VM_IPS],
+CMD_VM_WG_DOORS:[CMD_VM_IPS],
+CMD_VM_WG_UP:[CMD_VM_IPS],
+CMD_VM_WG_DOWN:[CMD_VM_IPS],
+CMD_VM_FW_UP:[CMD_VM_HONEYPOTS, CMD_VM_IPS],
+CMD_VM_FW_DOWN:[CMD_VM_HONEYPOTS, CMD_VM_IPS],
+CMD_VM_COMMIT:[CMD_VM_PHASE, CMD_VM_HONEYPOTS, CMD_VM_IPS],
+CMD_VM_SHUTDOWN:[CMD_VM_PHASE, CMD_VM_HONEYPOTS, CMD_VM_IPS]
+}
+
+# Commands whose answers depend on the phase (invalidated when it changes)
+VM_PHASE_DEPENDENT = [CMD_VM_PHASE, CMD_VM_HONEYPOTS, CMD_VM_IPS]